@@ -0,0 +1,122 @@
+"""Микробенчмарк диспетчеризации одного апдейта.
+
+Сравнивает старую схему (цепочка фильтров-лямбд и новая клавиатура на
+каждый ответ) с маршрутизацией через словарь и готовыми клавиатурами.
+Сеть не используется: обработчики возвращают методы, а не вызывают их.
+
+Запуск: python benchmarks/bench_dispatch.py
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault('BOT_TOKEN', '123456:bench')
+os.environ.setdefault('ADMIN_GROUP_ID', '-100123')
+workdir = tempfile.mkdtemp()
+os.environ.setdefault('BOT_DB_PATH', os.path.join(workdir, 'bench.db'))
+os.environ.setdefault('EVENT_LOG_DIR', os.path.join(workdir, 'events'))
+os.environ.setdefault('STATE_SNAPSHOT_PATH', os.path.join(workdir, 'snapshot.json.gz'))
+os.environ.setdefault('UPDATE_DEDUP_PERSIST', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+import main  # noqa: E402
+from aiogram import Dispatcher  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.filters import Command, CommandStart  # noqa: E402
+from aiogram.methods import SendMessage  # noqa: E402
+from aiogram.types import KeyboardButton, ReplyKeyboardMarkup, Update  # noqa: E402
+
+TEXTS = [
+    '/start',
+    '📤 Отправить данные',
+    '📰 Сообщить новость',
+    '✍️ Написать админам',
+    '❌ Закончить общение',
+    'просто текст',
+]
+
+
+def legacy_dispatcher():
+    """Диспетчер, собранный так, как до маршрутизатора"""
+    dp = Dispatcher()
+    dp.message(CommandStart())(main.start_handler)
+    dp.message(Command('stats'))(main.stats_handler)
+    dp.message(lambda message: message.text == "📤 Отправить данные")(main.send_file_handler)
+    dp.message(lambda message: message.text == "📰 Сообщить новость")(main.news_handler)
+    dp.message(lambda message: message.text == "✍️ Написать админам")(main.contact_admin_handler)
+    dp.message(lambda message: message.text == "❌ Закончить общение")(main.end_admin_chat_handler)
+    dp.message()(main.message_handler)
+    return dp
+
+
+def legacy_keyboard():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="📤 Отправить данные")],
+            [KeyboardButton(text="📰 Сообщить новость")],
+            [KeyboardButton(text="✍️ Написать админам")]
+        ],
+        resize_keyboard=True,
+        one_time_keyboard=False,
+        persistent=True
+    )
+
+
+def make_update(update_id, text):
+    return Update.model_validate({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': 42, 'type': 'private'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Bench'},
+            'text': text,
+        },
+    }, context={'bot': main.bot})
+
+
+async def dispatch_cost(dp, updates, rounds):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for _ in range(rounds):
+        for update in updates:
+            await dp.feed_update(main.bot, update)
+    return (loop.time() - start) / (rounds * len(updates))
+
+
+async def run(rounds):
+    # Отсев повторов сравнению не нужен: апдейты прогоняются по кругу
+    main.dp.update.outer_middleware._middlewares.clear()
+    updates = [make_update(i, text) for i, text in enumerate(TEXTS)]
+    before = await dispatch_cost(legacy_dispatcher(), updates, rounds)
+    after = await dispatch_cost(main.dp, updates, rounds)
+    print(f"feed_update:      было {before * 1e6:8.1f} мкс, стало {after * 1e6:8.1f} мкс")
+
+
+def serialize_cost(number):
+    legacy_session = AiohttpSession()
+    session = main.bot.session
+    before = timeit.timeit(
+        lambda: legacy_session.build_form_data(
+            main.bot, SendMessage(chat_id=42, text='hi', reply_markup=legacy_keyboard())
+        ),
+        number=number
+    ) / number
+    after = timeit.timeit(
+        lambda: session.build_form_data(
+            main.bot, SendMessage(chat_id=42, text='hi', reply_markup=main.MAIN_KEYBOARD)
+        ),
+        number=number
+    ) / number
+    print(f"ответ+клавиатура: было {before * 1e6:8.1f} мкс, стало {after * 1e6:8.1f} мкс")
+
+
+if __name__ == '__main__':
+    logging.disable(logging.INFO)
+    asyncio.run(run(rounds=2000))
+    serialize_cost(number=20000)
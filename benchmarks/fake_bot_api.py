@@ -0,0 +1,140 @@
+"""Заглушка Telegram Bot API для нагрузочных тестов.
+
+Отвечает на запросы бота правдоподобными объектами, записывает все вызовы
+и умеет добавлять задержку и ошибки RetryAfter (429). Апдейты, положенные
+через push_update(), отдаются боту в режиме polling по getUpdates.
+
+Отдельный запуск: python benchmarks/fake_bot_api.py --port 8081 --latency 0.05
+и затем BOT_API_URL=http://localhost:8081 python main.py
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """Заглушка Bot API на aiohttp"""
+
+    def __init__(self, latency=0.0, jitter=0.0, retry_after_rate=0.0, retry_after=1, bot_username='bench_bot'):
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.bot_username = bot_username
+        self.calls = []              # (время, метод, chat_id)
+        self.methods = Counter()
+        self.retry_after_sent = 0
+        self.in_flight = 0
+        self.bot_id = 0
+        # message_id сообщений, отправленных в каждый чат — на них можно "отвечать"
+        self.sent_messages = {}
+        self.pending_updates = []  # очередь для getUpdates
+        self._updates_arrived = None
+        self._last_update_id = 0
+        self._message_ids = itertools.count(1000)
+        self._random = random.Random(0)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    def push_update(self, update):
+        # Как и Telegram, нумеруем апдейты в порядке поступления: генератор мог
+        # выдать id заранее (части альбома), а getUpdates подтверждает по offset
+        self._last_update_id = max(self._last_update_id + 1, update['update_id'])
+        update['update_id'] = self._last_update_id
+        self.pending_updates.append(update)
+        if self._updates_arrived is not None:
+            self._updates_arrived.set()
+
+    async def _get_updates(self, data):
+        """getUpdates: подтверждает апдейты до offset и ждет новые до timeout секунд"""
+        offset = int(data.get('offset') or 0)
+        self.pending_updates = [u for u in self.pending_updates if u['update_id'] >= offset]
+        if not self.pending_updates:
+            self._updates_arrived = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._updates_arrived.wait(), timeout=float(data.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending_updates[:int(data.get('limit') or 100)]
+
+    def _message(self, chat_id, data):
+        message_id = next(self._message_ids)
+        self.sent_messages.setdefault(str(chat_id), []).append(message_id)
+        chat_type = 'supergroup' if str(chat_id).startswith('-') else 'private'
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': chat_type},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench'},
+        }
+        if 'text' in data:
+            message['text'] = data['text']
+        return message
+
+    async def handle(self, request):
+        self.in_flight += 1
+        try:
+            method = request.match_info['method']
+            token = request.match_info['token']
+            self.bot_id = int(token.split(':')[0])
+            data = dict(await request.post())
+            chat_id = data.get('chat_id')
+            self.calls.append((time.perf_counter(), method, chat_id))
+            self.methods[method] += 1
+            if self.latency or self.jitter:
+                await asyncio.sleep(self.latency + self._random.random() * self.jitter)
+            if chat_id is not None and self._random.random() < self.retry_after_rate:
+                self.retry_after_sent += 1
+                return web.json_response({
+                    'ok': False,
+                    'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after},
+                }, status=429)
+            if method == 'getUpdates':
+                # Длинный опрос висит постоянно — в in_flight считаем только отправку
+                self.in_flight -= 1
+                try:
+                    return web.json_response({'ok': True, 'result': await self._get_updates(data)})
+                finally:
+                    self.in_flight += 1
+            return web.json_response({'ok': True, 'result': self._result(method, chat_id, data)})
+        finally:
+            self.in_flight -= 1
+
+    def _result(self, method, chat_id, data):
+        if method == 'getMe':
+            return {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench', 'username': self.bot_username}
+        if method == 'copyMessage':
+            return {'message_id': self._message(chat_id, data)['message_id']}
+        if method == 'sendMediaGroup':
+            return [self._message(chat_id, data)]
+        if method.startswith('send') or method.startswith('edit'):
+            return self._message(chat_id, data)
+        return True
+
+    def report(self):
+        return dict(self.methods)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='доля ответов 429')
+    args = parser.parse_args()
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, retry_after_rate=args.retry_after_rate)
+    web.run_app(api.make_app(), port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""Нагрузочный тест webhook: заглушка Bot API + генератор апдейтов + отчет.
+
+Поднимает приложение из main.py и заглушку Bot API в одном процессе и шлет
+на WEBHOOK_PATH синтетические апдейты: /start, кнопки, текст, стикеры и
+гифки, фото и альбомы в режиме общения с админами и ответы админов. В конце печатает
+пропускную способность, перцентили задержки webhook и число вызовов
+Bot API на апдейт.
+
+Запуск: python benchmarks/load_webhook.py --users 50 --messages 20 --latency 0.02
+С --polling бот работает в режиме long polling: апдейты кладутся в очередь
+getUpdates заглушки, а вместо задержки webhook печатается число пачек.
+Лимиты планировщика отправки и входящих сообщений по умолчанию сняты,
+чтобы мерить сам бот; --telegram-limits возвращает реальные.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+BENCH_TOKEN = '123456:bench'
+ADMIN_GROUP_ID = '-100123'
+
+
+class ErrorCounter(logging.Handler):
+    """Считает ошибки в логе бота, чтобы сломанный путь не выглядел быстрым"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class UpdateFactory:
+    """Генератор синтетических апдейтов"""
+
+    def __init__(self, api, bot_id):
+        self.api = api
+        self.bot_id = bot_id
+        self._ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def _message(self, chat, user, **content):
+        update_id = next(self._ids)
+        return {
+            'update_id': update_id,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user, **content},
+        }
+
+    def private(self, user_id, **content):
+        return self._message({'id': user_id, 'type': 'private'}, self._user(user_id), **content)
+
+    def text(self, user_id, text):
+        return self.private(user_id, text=text)
+
+    def sticker(self, user_id):
+        return self.private(user_id, sticker={
+            'file_id': 'sticker-file', 'file_unique_id': 'sticker', 'type': 'regular',
+            'width': 512, 'height': 512, 'is_animated': False, 'is_video': False,
+        })
+
+    def animation(self, user_id):
+        return self.private(user_id, animation={
+            'file_id': 'gif-file', 'file_unique_id': 'gif', 'width': 320, 'height': 240, 'duration': 2,
+        }, caption='смотрите')
+
+    def photo(self, user_id, media_group_id=None, caption=None):
+        content = {'photo': [{'file_id': 'photo-file', 'file_unique_id': 'photo', 'width': 800, 'height': 600}]}
+        if media_group_id:
+            content['media_group_id'] = media_group_id
+        if caption:
+            content['caption'] = caption
+        return self.private(user_id, **content)
+
+    def album(self, user_id, size):
+        media_group_id = f'album-{next(self._ids)}'
+        return [
+            self.photo(user_id, media_group_id, caption='альбом' if i == 0 else None)
+            for i in range(size)
+        ]
+
+    def admin_reply(self, admin_id):
+        """Ответ админа на одно из сообщений бота в админском чате"""
+        sent = self.api.sent_messages.get(ADMIN_GROUP_ID)
+        if not sent:
+            return None
+        chat = {'id': int(ADMIN_GROUP_ID), 'type': 'supergroup', 'title': 'Admins'}
+        original = {
+            'message_id': random.choice(sent), 'date': int(time.time()), 'chat': chat,
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Bench'}, 'text': '...',
+        }
+        return self._message(chat, self._user(admin_id), text='Ответ админа', reply_to_message=original)
+
+
+def user_script(factory, user_id, messages):
+    """Последовательность апдейтов одного пользователя"""
+    yield factory.text(user_id, '/start')
+    yield factory.text(user_id, '✍️ Написать админам')
+    for i in range(messages):
+        kind = random.random()
+        if kind < 0.6:
+            yield factory.text(user_id, f'Сообщение {i}')
+        elif kind < 0.75:
+            yield factory.sticker(user_id)
+        elif kind < 0.85:
+            yield factory.animation(user_id)
+        elif kind < 0.95:
+            yield factory.photo(user_id, caption='фото')
+        else:
+            yield from factory.album(user_id, 3)
+    yield factory.text(user_id, '❌ Закончить общение')
+
+
+def admin_script(factory, admin_id, replies):
+    for _ in range(replies):
+        update = factory.admin_reply(admin_id)
+        if update is not None:
+            yield update
+
+
+async def run_client(session, url, updates, latencies, inline_replies, pause):
+    for update in updates:
+        started = time.perf_counter()
+        async with session.post(url, json=update) as response:
+            body = await response.read()
+        latencies.append(time.perf_counter() - started)
+        if b'name="method"' in body:
+            inline_replies.append(update['update_id'])
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def push_client(api, updates, pushed, pause):
+    """Кладет апдейты в очередь getUpdates заглушки (режим polling)"""
+    for update in updates:
+        api.push_update(update)
+        pushed.append(update['update_id'])
+        await asyncio.sleep(pause)
+
+
+async def wait_idle(main, api):
+    """Ждет, пока бот обработает все апдейты и отправит все запросы"""
+    quiet = 0
+    while quiet < 3:
+        coalescing = main.forward_coalescer.pending if main.forward_coalescer else 0
+        coalescing += main.inbound_limiter.pending if main.inbound_limiter else 0
+        busy = coalescing or main.media_groups.pending or main.update_counter.in_flight or main.update_pool.pending or main.send_scheduler.queue_depth or api.in_flight or api.pending_updates
+        quiet = 0 if busy else quiet + 1
+        await asyncio.sleep(0.01)
+
+
+async def run(args):
+    from benchmarks.fake_bot_api import FakeBotAPI
+
+    api = FakeBotAPI(latency=args.latency, jitter=args.jitter, retry_after_rate=args.retry_after_rate)
+    api_runner = web.AppRunner(api.make_app())
+    await api_runner.setup()
+    await web.TCPSite(api_runner, '127.0.0.1', args.api_port).start()
+
+    import main
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    if args.polling:
+        polling = asyncio.create_task(main.run_polling(args.bot_port))
+    else:
+        bot_runner = web.AppRunner(main.create_app())
+        await bot_runner.setup()
+        await web.TCPSite(bot_runner, '127.0.0.1', args.bot_port).start()
+    await asyncio.sleep(0.2)  # on_startup: getMe и setWebhook/deleteWebhook
+
+    factory = UpdateFactory(api, main.bot.id)
+    url = f'http://127.0.0.1:{args.bot_port}{main.WEBHOOK_PATH}'
+    latencies, inline_replies, pushed = [], [], []
+    calls_before = len(api.calls)
+    started = time.perf_counter()
+    if args.polling:
+        users = [push_client(api, user_script(factory, 1000 + i, args.messages), pushed, args.pause)
+                 for i in range(args.users)]
+        await asyncio.gather(*users)
+        # Ответы админов — когда в админском чате уже есть сообщения
+        await wait_idle(main, api)
+        admins = [push_client(api, admin_script(factory, 1 + i, args.replies), pushed, args.pause)
+                  for i in range(args.admins)]
+        await asyncio.gather(*admins)
+    else:
+        async with ClientSession() as session:
+            users = [
+                run_client(session, url, list(user_script(factory, 1000 + i, args.messages)),
+                           latencies, inline_replies, args.pause)
+                for i in range(args.users)
+            ]
+            await asyncio.gather(*users)
+            # Ответы админов — когда в админском чате уже есть сообщения
+            admins = [
+                run_client(session, url, admin_script(factory, 1 + i, args.replies), latencies, inline_replies, args.pause)
+                for i in range(args.admins)
+            ]
+            await asyncio.gather(*admins)
+    await wait_idle(main, api)
+    elapsed = time.perf_counter() - started
+
+    updates = len(pushed) if args.polling else len(latencies)
+    calls = len(api.calls) - calls_before
+    print(f"Апдейтов:               {updates}")
+    print(f"Время:                  {elapsed:.2f} с")
+    print(f"Пропускная способность: {updates / elapsed:.1f} апд/с")
+    if args.polling:
+        poller = main.update_poller
+        print(f"Long polling:           обработано {poller.updates} апдейтов в {poller.batches} пачках, "
+              f"ошибок getUpdates {poller.errors}")
+    else:
+        print(f"Задержка webhook:       p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+              f"p90 {percentile(latencies, 0.9) * 1000:.1f} мс, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс, макс {max(latencies) * 1000:.1f} мс")
+    print(f"Вызовов Bot API:        {calls} ({calls / updates:.2f} на апдейт), "
+          f"ответов в webhook: {len(inline_replies)}")
+    print(f"Ошибок в логе бота:     {errors.count}")
+    print(f"RetryAfter от заглушки: {api.retry_after_sent}, повторов планировщика: {main.send_scheduler.retries}")
+    print("По методам:             " + ', '.join(f"{m}={n}" for m, n in sorted(api.report().items())))
+    if main.inbound_limiter is not None:
+        print(f"Лимит на пользователя:  отложено {main.inbound_limiter.deferred}, "
+              f"отброшено {main.inbound_limiter.shed}")
+    print(f"Соединений с Bot API:   открыто {main.bot.session.opened}, переиспользовано {main.bot.session.reused}")
+
+    if args.polling:
+        main.update_poller.stop()
+        await polling
+    else:
+        await bot_runner.cleanup()
+    await api_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='параллельных пользователей')
+    parser.add_argument('--messages', type=int, default=10, help='сообщений админам на пользователя')
+    parser.add_argument('--admins', type=int, default=2, help='параллельных админов')
+    parser.add_argument('--replies', type=int, default=20, help='ответов на админа')
+    parser.add_argument('--pause', type=float, default=0.0, help='пауза между апдейтами клиента, с')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка Bot API, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, с')
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--telegram-limits', action='store_true', help='не снимать лимиты отправки и входящих сообщений')
+    parser.add_argument('--polling', action='store_true', help='режим long polling вместо webhook')
+    parser.add_argument('--bot-port', type=int, default=18080)
+    parser.add_argument('--api-port', type=int, default=18081)
+    args = parser.parse_args()
+
+    os.environ['BOT_TOKEN'] = BENCH_TOKEN
+    os.environ['ADMIN_GROUP_ID'] = ADMIN_GROUP_ID
+    os.environ['BOT_API_URL'] = f'http://127.0.0.1:{args.api_port}'
+    workdir = tempfile.mkdtemp()
+    os.environ.setdefault('BOT_DB_PATH', os.path.join(workdir, 'bench.db'))
+    os.environ.setdefault('EVENT_LOG_DIR', os.path.join(workdir, 'events'))
+    os.environ.setdefault('STATE_SNAPSHOT_PATH', os.path.join(workdir, 'snapshot.json.gz'))
+    os.environ.setdefault('UPDATE_DEDUP_PERSIST', '0')
+    if args.polling:
+        os.environ['BOT_MODE'] = 'polling'
+        os.environ.setdefault('POLLING_TIMEOUT', '1')
+    if not args.telegram_limits:
+        os.environ.setdefault('SEND_GLOBAL_PER_SECOND', '1000000')
+        os.environ.setdefault('SEND_GROUP_PER_MINUTE', '60000000')
+        os.environ.setdefault('SEND_PRIVATE_PER_SECOND', '1000000')
+        os.environ.setdefault('INBOUND_RATE', '0')
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    logging.basicConfig(level=logging.WARNING)
+    logging.disable(logging.INFO)
+    random.seed(0)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,37 @@
 import asyncio
+import base64
+import gzip
+import itertools
+import json
 import logging
+import math
+import mmap
 import os
-from datetime import datetime, timedelta
-from collections import defaultdict
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import CommandStart, Command
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+import re
+import signal
+import socket
+import sqlite3
+import struct
+import time
+from bisect import bisect_left
+from contextvars import ContextVar, copy_context
+from datetime import date, datetime, timedelta
+from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from aiogram import BaseMiddleware, Bot, Dispatcher, __version__ as aiogram_version, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest, TelegramConflictError, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import (
+    InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo,
+    KeyboardButton, ReplyKeyboardMarkup, Update
+)
+from aiogram.types.update import UpdateTypeLookupError
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiohttp import web
+from aiohttp import ClientSession, ClientTimeout, FormData, TraceConfig, web
+from aiohttp.http import SERVER_SOFTWARE
 from aiohttp.web_app import Application
 
 # Настройка логирования
@@ -19,80 +43,2107 @@ ADMIN_GROUP_ID = os.getenv('ADMIN_GROUP_ID')
 WEBHOOK_HOST = os.getenv('RENDER_EXTERNAL_URL', 'https://your-app.onrender.com')
 WEBHOOK_PATH = f'/webhook/{BOT_TOKEN}'
 WEBHOOK_URL = f'{WEBHOOK_HOST}{WEBHOOK_PATH}'
+# Адрес Bot API (свой сервер или заглушка из benchmarks/), по умолчанию api.telegram.org
+BOT_API_URL = os.getenv('BOT_API_URL')
+# Пул соединений с Bot API: всего соединений, сколько секунд держать
+# простаивающее, кэш DNS и сколько соединений открыть заранее при старте
+BOT_API_POOL_SIZE = int(os.getenv('BOT_API_POOL_SIZE', 100))
+BOT_API_KEEPALIVE = float(os.getenv('BOT_API_KEEPALIVE', 60))
+BOT_API_DNS_TTL = int(os.getenv('BOT_API_DNS_TTL', 3600))
+BOT_API_PREWARM = int(os.getenv('BOT_API_PREWARM', 4))
+
+# Файл SQLite для данных, которые должны переживать перезапуск
+BOT_DB_PATH = os.getenv('BOT_DB_PATH', 'bot_state.db')
+# Сколько связей сообщение→пользователь держать в памяти и сколько дней хранить
+ADMIN_LINKS_CAPACITY = int(os.getenv('ADMIN_LINKS_CAPACITY', 10000))
+ADMIN_LINKS_TTL = float(os.getenv('ADMIN_LINKS_TTL_DAYS', 30)) * 86400
+
+# Где хранить состояние: memory (один процесс), sqlite или redis (несколько процессов)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+STATE_SHARDS = int(os.getenv('STATE_SHARDS', 64))
+# Запуск нескольких процессов на одном порту (SO_REUSEPORT)
+WEB_REUSE_PORT = os.getenv('WEB_REUSE_PORT', '0') == '1'
+
+# Лимиты отправки Bot API: всего в секунду, в группу в минуту, в личку в секунду
+SEND_GLOBAL_PER_SECOND = float(os.getenv('SEND_GLOBAL_PER_SECOND', 30))
+SEND_GROUP_PER_MINUTE = float(os.getenv('SEND_GROUP_PER_MINUTE', 20))
+SEND_PRIVATE_PER_SECOND = float(os.getenv('SEND_PRIVATE_PER_SECOND', 1))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 3))
+
+# Входящие сообщения от одного пользователя: сколько в секунду и сколько
+# подряд без паузы (INBOUND_RATE=0 — без ограничения)
+INBOUND_RATE = float(os.getenv('INBOUND_RATE', 1))
+INBOUND_BURST = float(os.getenv('INBOUND_BURST', 10))
+
+# Режим работы: webhook (нужен публичный адрес) или polling (бот сам
+# забирает апдейты через getUpdates, публичный адрес и пинги не нужны)
+BOT_MODE = os.getenv('BOT_MODE', 'webhook')
+# Long polling: сколько апдейтов за один getUpdates (до 100) и сколько
+# секунд Telegram держит запрос, если апдейтов нет
+POLLING_LIMIT = int(os.getenv('POLLING_LIMIT', 100))
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', 25))
+
+# Обработка апдейтов: число воркеров (0 — без пула, как в aiogram по умолчанию),
+# предел очереди и что делать при переполнении webhook: block — ждать, shed — отказать
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))
+WEBHOOK_HIGH_WATER = int(os.getenv('WEBHOOK_HIGH_WATER', 200))
+WEBHOOK_OVERFLOW = os.getenv('WEBHOOK_OVERFLOW', 'block')
+# Сколько секунд ждать первый ответ, чтобы отдать его прямо в ответе на webhook
+WEBHOOK_REPLY_TIMEOUT = float(os.getenv('WEBHOOK_REPLY_TIMEOUT', 0.5))
+
+# Склеивание подряд идущих текстов пользователя в одно сообщение админам:
+# окно тишины в секундах (0 — выключено) и предел сообщений в пачке
+FORWARD_COALESCE_SECONDS = float(os.getenv('FORWARD_COALESCE_SECONDS', 0))
+FORWARD_COALESCE_MAX = int(os.getenv('FORWARD_COALESCE_MAX', 10))
+
+# Сколько секунд ждать остальные части альбома (media_group_id)
+MEDIA_GROUP_WINDOW = float(os.getenv('MEDIA_GROUP_WINDOW', 0.5))
+
+# Рассылка: сколько сообщений отправлять параллельно и как часто
+# обновлять сообщение с прогрессом в админском чате (секунды)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 10))
+BROADCAST_PROGRESS_SECONDS = float(os.getenv('BROADCAST_PROGRESS_SECONDS', 10))
+
+# Журнал событий для /stats за произвольный период: каталог с колонками
+# журнала (пусто — журнал выключен). Один каталог — один процесс, поэтому
+# при нескольких процессах на одном порту журнал выключен
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR', 'events') if not WEB_REUSE_PORT else ''
+
+# Сколько последних update_id помнить для отсева повторных доставок
+# и сохранять ли последний id в SQLite, чтобы отсев работал после перезапуска
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', 1000))
+UPDATE_DEDUP_PERSIST = os.getenv('UPDATE_DEDUP_PERSIST', '1') == '1'
+
+# Остановка: сколько секунд ждать обработки принятых апдейтов и отправок,
+# куда сохранить снимок состояния из памяти (пусто — не сохранять) и
+# сбрасывать ли апдейты, которые Telegram накопил за время перезапуска
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS', 20))
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'bot_snapshot.json.gz')
+WEBHOOK_DROP_PENDING = os.getenv('WEBHOOK_DROP_PENDING', '1') == '1'
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения!")
 
-if not ADMIN_GROUP_ID:
-    raise ValueError("ADMIN_GROUP_ID не найден в переменных окружения!")
+if not ADMIN_GROUP_ID:
+    raise ValueError("ADMIN_GROUP_ID не найден в переменных окружения!")
+
+class MessageLinkStore:
+    """Связи {message_id_от_бота_в_админ_чате: user_id}.
+
+    В памяти лежат последние `capacity` связей (LRU), все связи дублируются
+    в SQLite, поэтому ответы на старые сообщения работают и после перезапуска.
+    Связи старше `ttl` секунд считаются устаревшими и периодически удаляются.
+    """
+
+    # Как часто (в записях) чистить устаревшие связи на диске
+    PRUNE_EVERY = 500
+
+    def __init__(self, path, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._cache = OrderedDict()  # message_id -> (user_id, created_at)
+        self._writes = 0
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS admin_links ('
+            'message_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, created_at REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def _remember(self, message_id, user_id, created_at):
+        """Кладет связь в память, вытесняя самую давно использованную"""
+        self._cache[message_id] = (user_id, created_at)
+        self._cache.move_to_end(message_id)
+        if len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def get(self, message_id, default=None):
+        """Возвращает user_id по сообщению в админ-чате"""
+        now = time.time()
+        entry = self._cache.get(message_id)
+        if entry is None:
+            row = self._db.execute(
+                'SELECT user_id, created_at FROM admin_links WHERE message_id = ?',
+                (message_id,)
+            ).fetchone()
+            if row is None:
+                return default
+            entry = row
+        if now - entry[1] > self.ttl:
+            self._cache.pop(message_id, None)
+            return default
+        self._remember(message_id, *entry)
+        return entry[0]
+
+    def __setitem__(self, message_id, user_id):
+        now = time.time()
+        self._remember(message_id, user_id, now)
+        self._db.execute(
+            'INSERT OR REPLACE INTO admin_links (message_id, user_id, created_at) VALUES (?, ?, ?)',
+            (message_id, user_id, now)
+        )
+        self._db.commit()
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def dump(self):
+        """Связи из памяти в порядке LRU для снимка"""
+        return [[message_id, user_id, created_at] for message_id, (user_id, created_at) in self._cache.items()]
+
+    def load(self, entries):
+        for message_id, user_id, created_at in entries:
+            self._remember(message_id, user_id, created_at)
+
+    def prune(self):
+        """Удаляет устаревшие связи из памяти и с диска"""
+        deadline = time.time() - self.ttl
+        for message_id in [k for k, (_, created_at) in self._cache.items() if created_at < deadline]:
+            del self._cache[message_id]
+        self._db.execute('DELETE FROM admin_links WHERE created_at < ?', (deadline,))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+def _mix64(value):
+    """Перемешивает 64-битное число (splitmix64) — дешевый хеш для user_id"""
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+class UniqueCounter:
+    """Счетчик уникальных пользователей.
+
+    Пока пользователей меньше `threshold`, считает точно через множество,
+    дальше переходит на HyperLogLog с 2**precision регистрами (16 КБ при
+    precision=14, погрешность ~0.8%). Оценка поддерживается инкрементально,
+    поэтому len() работает за O(1).
+    """
+
+    def __init__(self, threshold=100000, precision=14):
+        self.threshold = threshold
+        self.precision = precision
+        self._exact = set()
+        self._registers = None
+        self._inverse_sum = 0.0  # сумма 2**-register по всем регистрам
+        self._zeros = 0          # количество нулевых регистров
+
+    def add(self, user_id):
+        if self._exact is not None:
+            self._exact.add(user_id)
+            if len(self._exact) > self.threshold:
+                self._switch_to_hll()
+            return
+        self._add_hashed(_mix64(user_id))
+
+    def _switch_to_hll(self):
+        size = 1 << self.precision
+        self._registers = bytearray(size)
+        self._inverse_sum = float(size)
+        self._zeros = size
+        for user_id in self._exact:
+            self._add_hashed(_mix64(user_id))
+        self._exact = None
+
+    def _add_hashed(self, hashed):
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        old = self._registers[index]
+        if rank > old:
+            self._registers[index] = rank
+            self._inverse_sum += 2.0 ** -rank - 2.0 ** -old
+            if old == 0:
+                self._zeros -= 1
+
+    def dump(self):
+        if self._exact is not None:
+            return {'exact': list(self._exact)}
+        return {'registers': base64.b64encode(self._registers).decode()}
+
+    def load(self, data):
+        if 'exact' in data:
+            self._exact = set(data['exact'])
+            self._registers = None
+            return
+        self._exact = None
+        self._registers = bytearray(base64.b64decode(data['registers']))
+        self._inverse_sum = sum(2.0 ** -register for register in self._registers)
+        self._zeros = self._registers.count(0)
+
+    def __len__(self):
+        if self._exact is not None:
+            return len(self._exact)
+        size = len(self._registers)
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / self._inverse_sum
+        if estimate <= 2.5 * size and self._zeros:
+            # Поправка для малых значений (linear counting)
+            estimate = size * math.log(size / self._zeros)
+        return int(estimate)
+
+class RollingStats:
+    """Статистика сообщений на кольцевых буферах.
+
+    Хранит счетчики за последние `days` дней и 24 часа. Истекшие корзины
+    обнуляются при переходе на новый день/час, а суммы по окнам ведутся
+    на лету, так что и запись, и чтение агрегатов стоят O(1).
+    """
+
+    HOURS = 24
+
+    def __init__(self, days=7):
+        self.total_users = UniqueCounter()
+        self._days = [0] * days
+        self._hours = [0] * self.HOURS
+        self._current_day = None   # номер дня (date.toordinal) последней корзины
+        self._current_hour = None  # номер часа от начала эпохи дат
+        self._week_total = 0
+        self._hours_total = 0
+
+    @staticmethod
+    def _advance(buckets, current, target):
+        """Обнуляет корзины между current и target, возвращает сумму удаленного"""
+        if current is None or target <= current:
+            return 0
+        removed = 0
+        for key in range(max(current + 1, target - len(buckets) + 1), target + 1):
+            index = key % len(buckets)
+            removed += buckets[index]
+            buckets[index] = 0
+        return removed
+
+    def _roll(self, now):
+        day = now.toordinal()
+        hour = day * self.HOURS + now.hour
+        self._week_total -= self._advance(self._days, self._current_day, day)
+        self._hours_total -= self._advance(self._hours, self._current_hour, hour)
+        if self._current_day is None or day > self._current_day:
+            self._current_day = day
+        if self._current_hour is None or hour > self._current_hour:
+            self._current_hour = hour
+
+    def record(self, user_id, now=None):
+        """Учитывает одно сообщение пользователя"""
+        self._roll(now or datetime.now())
+        self.total_users.add(user_id)
+        self._days[self._current_day % len(self._days)] += 1
+        self._hours[self._current_hour % self.HOURS] += 1
+        self._week_total += 1
+        self._hours_total += 1
+
+    def dump(self):
+        return {
+            'users': self.total_users.dump(),
+            'days': self._days,
+            'hours': self._hours,
+            'current_day': self._current_day,
+            'current_hour': self._current_hour,
+        }
+
+    def load(self, data):
+        if len(data['days']) != len(self._days):
+            return  # Окно поменялось — счетчики сообщений начнутся заново
+        self.total_users.load(data['users'])
+        self._days = list(data['days'])
+        self._hours = list(data['hours'])
+        self._current_day = data['current_day']
+        self._current_hour = data['current_hour']
+        self._week_total = sum(self._days)
+        self._hours_total = sum(self._hours)
+
+    @property
+    def messages_this_week(self):
+        self._roll(datetime.now())
+        return self._week_total
+
+    @property
+    def messages_last_24h(self):
+        self._roll(datetime.now())
+        return self._hours_total
+
+    @property
+    def messages_today(self):
+        self._roll(datetime.now())
+        return self._days[self._current_day % len(self._days)]
+
+    def recent_days(self):
+        """Пары (дата, сообщений) за окно, от старых к сегодняшнему дню"""
+        self._roll(datetime.now())
+        today = date.fromordinal(self._current_day)
+        return [
+            (today - timedelta(days=i), self._days[(self._current_day - i) % len(self._days)])
+            for i in range(len(self._days) - 1, -1, -1)
+        ]
+
+class StateBackend:
+    """Интерфейс хранилища состояния бота.
+
+    Все методы асинхронные, чтобы за ними могла стоять сеть. Обработчики
+    работают только через этот интерфейс, поэтому с общим хранилищем
+    (SQLite или Redis) один webhook могут обслуживать несколько процессов.
+    """
+
+    async def is_waiting(self, user_id):
+        """Включен ли у пользователя режим общения с админами"""
+        raise NotImplementedError
+
+    async def set_waiting(self, user_id, value):
+        raise NotImplementedError
+
+    async def record_message(self, user_id, waiting=None):
+        """Учитывает сообщение в статистике и, если передано, меняет режим
+        общения с админами — одной операцией"""
+        raise NotImplementedError
+
+    async def get_link(self, message_id):
+        """Возвращает user_id по сообщению бота в админском чате"""
+        raise NotImplementedError
+
+    async def set_link(self, message_id, user_id):
+        raise NotImplementedError
+
+    async def stats_snapshot(self):
+        """Словарь с агрегатами: total_users, today, last_24h, week, recent_days"""
+        raise NotImplementedError
+
+    async def iter_users(self, after=0, page=500):
+        """Известные пользователи с id больше `after` по возрастанию, страницами"""
+        raise NotImplementedError
+        yield
+
+    async def count_users(self):
+        raise NotImplementedError
+
+    async def remove_user(self, user_id):
+        """Забывает пользователя (например, заблокировавшего бота)"""
+        raise NotImplementedError
+
+    async def get_meta(self, key):
+        """Служебное строковое значение (чекпоинты и т.п.) или None"""
+        raise NotImplementedError
+
+    async def set_meta(self, key, value):
+        raise NotImplementedError
+
+    async def acquire_lease(self, name, owner, ttl):
+        """Берет или продлевает аренду на ttl секунд; False — она у другого процесса"""
+        raise NotImplementedError
+
+    async def release_lease(self, name, owner):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Состояние из памяти для сохранения при остановке (None — нечего сохранять)"""
+        return None
+
+    def restore(self, data):
+        """Восстанавливает состояние из snapshot()"""
+
+    def sizes(self):
+        """Размеры структур в памяти процесса для /metrics"""
+        return {}
+
+    async def close(self):
+        pass
+
+class SQLiteUsersMixin:
+    """Список пользователей и служебные значения в таблицах users и meta"""
+
+    def _create_users_tables(self):
+        self._db.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._db.commit()
+
+    async def iter_users(self, after=0, page=500):
+        while True:
+            rows = self._db.execute(
+                'SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?', (after, page)
+            ).fetchall()
+            for (user_id,) in rows:
+                yield user_id
+            if len(rows) < page:
+                return
+            after = rows[-1][0]
+
+    async def count_users(self):
+        return self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    async def remove_user(self, user_id):
+        with self._db:
+            self._db.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+
+    async def get_meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    async def set_meta(self, key, value):
+        with self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    async def acquire_lease(self, name, owner, ttl):
+        # Аренда — строка '<владелец> <истекает>' в meta; BEGIN IMMEDIATE
+        # не дает двум процессам одновременно прочитать и перезаписать ее
+        now = time.time()
+        with self._db:
+            self._db.execute('BEGIN IMMEDIATE')
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (f'lease:{name}',)).fetchone()
+            if row is not None:
+                holder, _, expires = row[0].rpartition(' ')
+                if holder != owner and float(expires) > now:
+                    return False
+            self._db.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (f'lease:{name}', f'{owner} {now + ttl}')
+            )
+        return True
+
+    async def release_lease(self, name, owner):
+        with self._db:
+            self._db.execute(
+                "DELETE FROM meta WHERE key = ? AND value LIKE ? || ' %'", (f'lease:{name}', owner)
+            )
+
+class MemoryStateBackend(SQLiteUsersMixin, StateBackend):
+    """Состояние в памяти одного процесса.
+
+    Связи, список пользователей (для рассылок) и служебные значения
+    дублируются в SQLite.
+    """
+
+    def __init__(self, path):
+        self.waiting = {}
+        self.links = MessageLinkStore(path, capacity=ADMIN_LINKS_CAPACITY, ttl=ADMIN_LINKS_TTL)
+        self.stats = RollingStats()
+        self._db = sqlite3.connect(path)
+        self._create_users_tables()
+
+    async def is_waiting(self, user_id):
+        return self.waiting.get(user_id, False)
+
+    async def set_waiting(self, user_id, value):
+        self.waiting[user_id] = value
+
+    async def record_message(self, user_id, waiting=None):
+        self.stats.record(user_id)
+        if waiting is not None:
+            self.waiting[user_id] = waiting
+        with self._db:
+            self._db.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+
+    async def remove_user(self, user_id):
+        self.waiting.pop(user_id, None)
+        await super().remove_user(user_id)
+
+    async def get_link(self, message_id):
+        return self.links.get(message_id)
+
+    async def set_link(self, message_id, user_id):
+        self.links[message_id] = user_id
+
+    async def stats_snapshot(self):
+        return {
+            'total_users': len(self.stats.total_users),
+            'today': self.stats.messages_today,
+            'last_24h': self.stats.messages_last_24h,
+            'week': self.stats.messages_this_week,
+            'recent_days': self.stats.recent_days(),
+        }
+
+    def snapshot(self):
+        return {
+            'waiting': [user_id for user_id, waiting in self.waiting.items() if waiting],
+            'stats': self.stats.dump(),
+            'links': self.links.dump(),
+        }
+
+    def restore(self, data):
+        self.waiting.update(dict.fromkeys(data['waiting'], True))
+        self.stats.load(data['stats'])
+        self.links.load(data['links'])
+
+    def sizes(self):
+        return {'admin_links': len(self.links), 'waiting_users': len(self.waiting)}
+
+    async def close(self):
+        self.links.close()
+        self._db.close()
+
+class SQLiteStateBackend(SQLiteUsersMixin, StateBackend):
+    """Состояние в SQLite в режиме WAL.
+
+    Подходит для нескольких процессов на одной машине. Статистика хранится
+    по дням и часам, каждое сообщение — одна короткая транзакция. Связи
+    сообщений не меняются, поэтому кешируются в MessageLinkStore.
+    """
+
+    # Как часто (в записях) удалять старые корзины статистики
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, days=7):
+        self.days = days
+        self.links = MessageLinkStore(path, capacity=ADMIN_LINKS_CAPACITY, ttl=ADMIN_LINKS_TTL)
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, waiting INTEGER NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS stats_days (day INTEGER PRIMARY KEY, count INTEGER NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS stats_hours (hour INTEGER PRIMARY KEY, count INTEGER NOT NULL);'
+        )
+        self._create_users_tables()
+
+    async def is_waiting(self, user_id):
+        row = self._db.execute('SELECT waiting FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        return bool(row and row[0])
+
+    async def set_waiting(self, user_id, value):
+        with self._db:
+            self._set_waiting(user_id, value)
+
+    def _set_waiting(self, user_id, value):
+        self._db.execute(
+            'INSERT OR REPLACE INTO user_state (user_id, waiting) VALUES (?, ?)',
+            (user_id, int(value))
+        )
+
+    async def record_message(self, user_id, waiting=None):
+        now = datetime.now()
+        day = now.toordinal()
+        hour = day * 24 + now.hour
+        with self._db:
+            self._db.execute(
+                'INSERT INTO stats_days (day, count) VALUES (?, 1) '
+                'ON CONFLICT(day) DO UPDATE SET count = count + 1', (day,)
+            )
+            self._db.execute(
+                'INSERT INTO stats_hours (hour, count) VALUES (?, 1) '
+                'ON CONFLICT(hour) DO UPDATE SET count = count + 1', (hour,)
+            )
+            if self._db.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,)).rowcount:
+                self._db.execute(
+                    "INSERT INTO meta (key, value) VALUES ('total_users', 1) "
+                    "ON CONFLICT(key) DO UPDATE SET value = value + 1"
+                )
+            if waiting is not None:
+                self._set_waiting(user_id, waiting)
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._db.execute('DELETE FROM stats_days WHERE day <= ?', (day - self.days,))
+                self._db.execute('DELETE FROM stats_hours WHERE hour <= ?', (hour - 24,))
+
+    async def remove_user(self, user_id):
+        with self._db:
+            self._db.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            self._db.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+
+    async def get_link(self, message_id):
+        return self.links.get(message_id)
+
+    async def set_link(self, message_id, user_id):
+        self.links[message_id] = user_id
+
+    async def stats_snapshot(self):
+        now = datetime.now()
+        day = now.toordinal()
+        hour = day * 24 + now.hour
+        days = dict(self._db.execute(
+            'SELECT day, count FROM stats_days WHERE day > ?', (day - self.days,)
+        ).fetchall())
+        last_24h = self._db.execute(
+            'SELECT COALESCE(SUM(count), 0) FROM stats_hours WHERE hour > ?', (hour - 24,)
+        ).fetchone()[0]
+        total_users = self._db.execute("SELECT value FROM meta WHERE key = 'total_users'").fetchone()
+        return {
+            'total_users': int(total_users[0]) if total_users else 0,
+            'today': days.get(day, 0),
+            'last_24h': last_24h,
+            'week': sum(days.values()),
+            'recent_days': [
+                (date.fromordinal(d), days.get(d, 0)) for d in range(day - self.days + 1, day + 1)
+            ],
+        }
+
+    def sizes(self):
+        return {'admin_links': len(self.links)}
+
+    async def close(self):
+        self.links.close()
+        self._db.close()
+
+class RedisError(Exception):
+    """Ошибка, которую вернул Redis"""
+
+class RedisConnection:
+    """Минимальный клиент протокола Redis (RESP) с конвейером команд.
+
+    Все команды конвейера уходят одной записью в сокет, ответы читаются
+    подряд, так что пачка команд стоит один сетевой round trip.
+    """
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode()
+        if kind == b'-':
+            return RedisError(body.decode())
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            if int(body) < 0:
+                return None
+            return (await self._reader.readexactly(int(body) + 2))[:-2]
+        if kind == b'*':
+            if int(body) < 0:
+                return None
+            return [await self._read_reply() for _ in range(int(body))]
+        raise RedisError(f"Непонятный ответ Redis: {line!r}")
+
+    async def _roundtrip(self, commands):
+        self._writer.write(b''.join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def pipeline(self, *commands):
+        """Выполняет команды одним пакетом и возвращает список ответов"""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                    setup = ([('AUTH', self.password)] if self.password else []) + [('SELECT', self.db)]
+                    commands = setup + list(commands)
+                    replies = (await self._roundtrip(commands))[len(setup):]
+                else:
+                    replies = await self._roundtrip(commands)
+            except BaseException:
+                # После обрыва или отмены посреди обмена в сокете могут остаться
+                # непрочитанные ответы, и следующая команда получила бы чужой
+                await self.close()
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *command):
+        return (await self.pipeline(command))[0]
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+class RedisStateBackend(StateBackend):
+    """Состояние в Redis (или любом сервере с его протоколом).
+
+    Флаги режима лежат в хешах, разбитых по user_id на `shards` частей
+    (bot:waiting:{N}), связи — в отдельных ключах с TTL, статистика —
+    в счетчиках по дням и часам плюс HyperLogLog для пользователей.
+    Список пользователей для рассылок — sorted set с user_id в score.
+    """
+
+    USERS_KEY = 'bot:stats:users'
+    DIRECTORY_KEY = 'bot:users'
+
+    def __init__(self, url, shards=64, days=7):
+        self.shards = shards
+        self.days = days
+        self.redis = RedisConnection(url)
+
+    def _waiting_key(self, user_id):
+        return f'bot:waiting:{{{user_id % self.shards}}}'
+
+    async def is_waiting(self, user_id):
+        return await self.redis.execute('HGET', self._waiting_key(user_id), user_id) == b'1'
+
+    async def set_waiting(self, user_id, value):
+        await self.redis.execute('HSET', self._waiting_key(user_id), user_id, int(value))
+
+    async def record_message(self, user_id, waiting=None):
+        now = datetime.now()
+        day = now.toordinal()
+        day_key = f'bot:stats:day:{day}'
+        hour_key = f'bot:stats:hour:{day * 24 + now.hour}'
+        commands = [
+            ('INCR', day_key),
+            ('EXPIRE', day_key, (self.days + 1) * 86400),
+            ('INCR', hour_key),
+            ('EXPIRE', hour_key, 25 * 3600),
+            ('PFADD', self.USERS_KEY, user_id),
+            ('ZADD', self.DIRECTORY_KEY, 'NX', user_id, user_id),
+        ]
+        if waiting is not None:
+            commands.append(('HSET', self._waiting_key(user_id), user_id, int(waiting)))
+        await self.redis.pipeline(*commands)
+
+    async def get_link(self, message_id):
+        value = await self.redis.execute('GET', f'bot:link:{message_id}')
+        return int(value) if value is not None else None
+
+    async def set_link(self, message_id, user_id):
+        await self.redis.execute('SET', f'bot:link:{message_id}', user_id, 'EX', int(ADMIN_LINKS_TTL))
+
+    async def stats_snapshot(self):
+        now = datetime.now()
+        day = now.toordinal()
+        hour = day * 24 + now.hour
+        day_numbers = list(range(day - self.days + 1, day + 1))
+        days, hours, total_users = await self.redis.pipeline(
+            ('MGET', *[f'bot:stats:day:{d}' for d in day_numbers]),
+            ('MGET', *[f'bot:stats:hour:{h}' for h in range(hour - 23, hour + 1)]),
+            ('PFCOUNT', self.USERS_KEY),
+        )
+        days = [int(count or 0) for count in days]
+        return {
+            'total_users': total_users,
+            'today': days[-1],
+            'last_24h': sum(int(count or 0) for count in hours),
+            'week': sum(days),
+            'recent_days': [(date.fromordinal(d), count) for d, count in zip(day_numbers, days)],
+        }
+
+    async def iter_users(self, after=0, page=500):
+        while True:
+            members = await self.redis.execute(
+                'ZRANGEBYSCORE', self.DIRECTORY_KEY, f'({after}', '+inf', 'LIMIT', 0, page
+            )
+            for member in members:
+                yield int(member)
+            if len(members) < page:
+                return
+            after = int(members[-1])
+
+    async def count_users(self):
+        return await self.redis.execute('ZCARD', self.DIRECTORY_KEY)
+
+    async def remove_user(self, user_id):
+        await self.redis.pipeline(
+            ('ZREM', self.DIRECTORY_KEY, user_id),
+            ('HDEL', self._waiting_key(user_id), user_id),
+        )
+
+    async def get_meta(self, key):
+        value = await self.redis.execute('GET', f'bot:meta:{key}')
+        return value.decode() if value is not None else None
+
+    async def set_meta(self, key, value):
+        await self.redis.execute('SET', f'bot:meta:{key}', value)
+
+    async def acquire_lease(self, name, owner, ttl):
+        key = f'bot:lease:{name}'
+        if await self.redis.execute('SET', key, owner, 'NX', 'PX', int(ttl * 1000)) is not None:
+            return True
+        if await self.redis.execute('GET', key) == owner.encode():
+            await self.redis.execute('PEXPIRE', key, int(ttl * 1000))
+            return True
+        return False
+
+    async def release_lease(self, name, owner):
+        key = f'bot:lease:{name}'
+        if await self.redis.execute('GET', key) == owner.encode():
+            await self.redis.execute('DEL', key)
+
+    async def close(self):
+        await self.redis.close()
+
+def create_state_backend(kind):
+    """Создает хранилище состояния по значению STATE_BACKEND"""
+    if kind == 'memory':
+        return MemoryStateBackend(BOT_DB_PATH)
+    if kind == 'sqlite':
+        return SQLiteStateBackend(BOT_DB_PATH)
+    if kind == 'redis':
+        return RedisStateBackend(REDIS_URL, shards=STATE_SHARDS)
+    raise ValueError(f"Неизвестный STATE_BACKEND: {kind}")
+
+# Состояние бота: режимы пользователей, связи сообщений и статистика
+state = create_state_backend(STATE_BACKEND)
+
+# Время запуска этого процесса
+started_at = datetime.now()
+
+# Типы событий в журнале
+EVENT_OTHER = 0
+EVENT_START = 1    # /start
+EVENT_COMMAND = 2  # другие команды
+EVENT_BUTTON = 3   # нажатие кнопки
+EVENT_MESSAGE = 4  # прочие сообщения пользователя
+EVENT_ADMIN = 5    # сообщения в админском чате
+
+class EventLog:
+    """Журнал событий только на дозапись, по столбцам.
+
+    Каждое событие — запись фиксированной ширины, разложенная по трем
+    файлам-колонкам: время (uint32), user_id (int64) и тип (uint8), всего
+    13 байт. Читаются колонки через mmap без создания Python-объектов.
+    Часовые и дневные агрегаты ведутся инкрементально в SQLite: изменения
+    копятся в памяти и сбрасываются пачкой, а позиция последнего учтенного
+    события хранится в meta, так что после сбоя хвост журнала доигрывается.
+    """
+
+    COLUMNS = (('ts', 'I'), ('user', 'q'), ('kind', 'B'))
+    FLUSH_EVERY = 200
+    FLUSH_SECONDS = 5.0
+
+    def __init__(self, directory, db_path):
+        os.makedirs(directory, exist_ok=True)
+        self._paths = {name: os.path.join(directory, f'{name}.col') for name, _ in self.COLUMNS}
+        self._packers = {name: struct.Struct('<' + code).pack for name, code in self.COLUMNS}
+        # После сбоя посреди записи колонки могут разойтись — обрезаем по самой короткой
+        self.count = min(
+            (os.path.getsize(path) if os.path.exists(path) else 0) // struct.calcsize(code)
+            for (name, code), path in zip(self.COLUMNS, self._paths.values())
+        )
+        self._files = {}
+        for name, code in self.COLUMNS:
+            column = open(self._paths[name], 'ab')
+            column.truncate(self.count * struct.calcsize(code))
+            self._files[name] = column
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS rollup_hours ('
+            'hour INTEGER NOT NULL, kind INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (hour, kind));'
+            'CREATE TABLE IF NOT EXISTS rollup_user_days ('
+            'day INTEGER NOT NULL, user_id INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (day, user_id));'
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);'
+        )
+        self._pending_hours = {}  # (час, тип) -> количество
+        self._pending_users = {}  # (день, user_id) -> количество
+        self._flushed_at = time.monotonic()
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'event_log_position'").fetchone()
+        self._applied = min(int(row[0]), self.count) if row else 0
+        self._replay()
+
+    def _replay(self):
+        """Доигрывает в агрегаты события, записанные после последнего сброса"""
+        if self._applied >= self.count:
+            return
+        columns = self.columns()
+        try:
+            for index in range(self._applied, self.count):
+                self._roll(columns['ts'][index], columns['user'][index], columns['kind'][index])
+        finally:
+            self._release(columns)
+        self.flush()
+
+    def columns(self):
+        """Колонки журнала как memoryview поверх mmap (освобождать через _release)"""
+        views = {}
+        for name, code in self.COLUMNS:
+            self._files[name].flush()
+            with open(self._paths[name], 'rb') as column:
+                mapped = mmap.mmap(column.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+            views[name] = memoryview(mapped).cast(code)[:self.count]
+        return views
+
+    @staticmethod
+    def _release(columns):
+        for view in columns.values():
+            obj = view.obj
+            view.release()
+            if isinstance(obj, mmap.mmap):
+                obj.close()
+
+    def _roll(self, ts, user_id, kind):
+        moment = datetime.fromtimestamp(ts)
+        day = moment.toordinal()
+        key = (day * 24 + moment.hour, kind)
+        self._pending_hours[key] = self._pending_hours.get(key, 0) + 1
+        if kind != EVENT_ADMIN:
+            key = (day, user_id)
+            self._pending_users[key] = self._pending_users.get(key, 0) + 1
+
+    def append(self, user_id, kind, ts=None):
+        ts = int(ts if ts is not None else time.time())
+        files = self._files
+        files['ts'].write(self._packers['ts'](ts))
+        files['user'].write(self._packers['user'](user_id))
+        files['kind'].write(self._packers['kind'](kind))
+        self.count += 1
+        self._roll(ts, user_id, kind)
+        if (self.count - self._applied >= self.FLUSH_EVERY
+                or time.monotonic() - self._flushed_at >= self.FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        """Сбрасывает колонки на диск и накопленные изменения в агрегаты"""
+        for column in self._files.values():
+            column.flush()
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO rollup_hours (hour, kind, count) VALUES (?, ?, ?) '
+                'ON CONFLICT(hour, kind) DO UPDATE SET count = count + excluded.count',
+                [(hour, kind, count) for (hour, kind), count in self._pending_hours.items()]
+            )
+            self._db.executemany(
+                'INSERT INTO rollup_user_days (day, user_id, count) VALUES (?, ?, ?) '
+                'ON CONFLICT(day, user_id) DO UPDATE SET count = count + excluded.count',
+                [(day, user_id, count) for (day, user_id), count in self._pending_users.items()]
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('event_log_position', ?)", (str(self.count),)
+            )
+        self._pending_hours.clear()
+        self._pending_users.clear()
+        self._applied = self.count
+        self._flushed_at = time.monotonic()
+
+    def report(self, first_day, last_day, top=5):
+        """Агрегаты за дни [first_day, last_day] (date) только по сводным таблицам"""
+        self.flush()
+        first, last = first_day.toordinal(), last_day.toordinal()
+        hours = (first * 24, last * 24 + 23)
+        by_kind = dict(self._db.execute(
+            'SELECT kind, SUM(count) FROM rollup_hours WHERE hour BETWEEN ? AND ? GROUP BY kind', hours
+        ).fetchall())
+        busiest_hours = self._db.execute(
+            'SELECT hour % 24 AS hour_of_day, SUM(count) AS total FROM rollup_hours '
+            'WHERE hour BETWEEN ? AND ? AND kind != ? GROUP BY hour_of_day ORDER BY total DESC LIMIT 3',
+            (*hours, EVENT_ADMIN)
+        ).fetchall()
+        users, = self._db.execute(
+            'SELECT COUNT(DISTINCT user_id) FROM rollup_user_days WHERE day BETWEEN ? AND ?', (first, last)
+        ).fetchone()
+        top_senders = self._db.execute(
+            'SELECT user_id, SUM(count) AS total FROM rollup_user_days WHERE day BETWEEN ? AND ? '
+            'GROUP BY user_id ORDER BY total DESC LIMIT ?', (first, last, top)
+        ).fetchall()
+        return {
+            'by_kind': by_kind,
+            'users': users,
+            'top_senders': top_senders,
+            'busiest_hours': busiest_hours,
+        }
+
+    def close(self):
+        self.flush()
+        for column in self._files.values():
+            column.close()
+        self._db.close()
+
+class TokenBucket:
+    """Простое ведро токенов: `rate` токенов в секунду, не больше `capacity`"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0  # выставляется после RetryAfter
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Через сколько секунд можно будет взять токен"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+# Приоритеты исходящих запросов: чем меньше число, тем раньше уходит запрос
+PRIORITY_ADMIN_REPLY = 0   # ответы админов пользователям
+PRIORITY_DEFAULT = 1       # пересылка админам и прочее
+PRIORITY_CONFIRMATION = 2  # подтверждения пользователю
+PRIORITY_BROADCAST = 3     # рассылки
+
+# Приоритет запросов текущего обработчика
+send_priority = ContextVar('send_priority', default=PRIORITY_DEFAULT)
+
+# Метод, который вернул обработчик кнопки или команды, и еще не отправленный:
+# (метод, имя обработчика, начало обработки) — время пишется после отправки
+pending_reply = ContextVar('pending_reply', default=None)
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик всех запросов к Bot API с учетом лимитов Telegram.
+
+    Подключается как middleware сессии, поэтому через него проходят и
+    bot.send_*, и message.answer/reply. Запросы с chat_id ждут токен в общем
+    ведре и в ведре чата, очередь разбирается по приоритету (send_priority),
+    а при RetryAfter чат блокируется на указанное время и запрос повторяется.
+    """
+
+    # После скольких ведер чатов выбрасывать простаивающие
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate, group_per_minute, private_rate, max_retries):
+        self.group_rate = group_per_minute / 60
+        self.group_capacity = max(1.0, group_per_minute)
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1.0, global_rate), time.monotonic())
+        self._chats = {}
+        self._queue = []  # [(priority, seq, chat_key, future)]
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._pump_task = None
+        # Счетчики
+        self.sent = 0
+        self.delayed = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def _bucket(self, chat_key, now):
+        bucket = self._chats.get(chat_key)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                for key in [k for k, b in self._chats.items() if b.is_idle(now)]:
+                    del self._chats[key]
+            if chat_key.startswith('-'):
+                bucket = TokenBucket(self.group_rate, self.group_capacity, now)
+            else:
+                bucket = TokenBucket(self.private_rate, max(1.0, self.private_rate * 3), now)
+            self._chats[chat_key] = bucket
+        return bucket
+
+    async def _acquire(self, chat_key, priority):
+        """Ждет своей очереди на отправку в чат"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        bucket = self._bucket(chat_key, now)
+        if not self._queue and not self._global.delay(now) and not bucket.delay(now):
+            self._global.take(now)
+            bucket.take(now)
+            return
+        future = loop.create_future()
+        self._queue.append((priority, next(self._seq), chat_key, future))
+        self.delayed += 1
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        else:
+            self._wakeup.set()
+        await future
+        waited = loop.time() - now
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    async def _pump(self):
+        """Выпускает запросы из очереди по мере появления токенов"""
+        loop = asyncio.get_running_loop()
+        while self._queue:
+            now = loop.time()
+            pause = self._global.delay(now)
+            if not pause:
+                ready = [
+                    entry for entry in self._queue
+                    if entry[3].cancelled() or not self._bucket(entry[2], now).delay(now)
+                ]
+                if ready:
+                    entry = min(ready)
+                    self._queue.remove(entry)
+                    if not entry[3].cancelled():
+                        self._global.take(now)
+                        self._chats[entry[2]].take(now)
+                        entry[3].set_result(None)
+                    continue
+                pause = min(self._bucket(entry[2], now).delay(now) for entry in self._queue)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=pause)
+            except asyncio.TimeoutError:
+                pass
+
+    def try_acquire(self, method):
+        """Берет токены для метода без ожидания; False — токенов сейчас нет.
+
+        Нужен для ответов прямо в webhook: они не проходят через сессию,
+        но расходуют те же лимиты Telegram.
+        """
+        now = asyncio.get_running_loop().time()
+        if self._queue or self._global.delay(now):
+            return False
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is not None:
+            bucket = self._bucket(str(chat_id), now)
+            if bucket.delay(now):
+                return False
+            bucket.take(now)
+        self._global.take(now)
+        self.sent += 1
+        return True
+
+    async def drain(self):
+        """Ждет, пока очередь отправки опустеет"""
+        while self._pump_task is not None and not self._pump_task.done():
+            await asyncio.shield(self._pump_task)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        chat_key = str(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_key, send_priority.get())
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                loop = asyncio.get_running_loop()
+                self._bucket(chat_key, loop.time()).blocked_until = loop.time() + e.retry_after
+                logging.warning(f"RetryAfter {e.retry_after} с для чата {chat_key}, повтор #{attempt + 1}")
+                continue
+            self.sent += 1
+            return result
+
+send_scheduler = SendScheduler(
+    global_rate=SEND_GLOBAL_PER_SECOND,
+    group_per_minute=SEND_GROUP_PER_MINUTE,
+    private_rate=SEND_PRIVATE_PER_SECOND,
+    max_retries=SEND_MAX_RETRIES
+)
+
+class UpdateDeduplicator(BaseMiddleware):
+    """Отсеивает повторные доставки одного и того же апдейта.
+
+    Помнит последние `window` update_id: кольцо (deque) задает порядок
+    вытеснения, множество дает проверку за O(1). Если передан путь к базе,
+    окно сохраняется в таблицу meta, и после перезапуска повторами считаются
+    только апдейты, которые действительно были обработаны: те, что были
+    в обработке в момент сбоя или не были приняты (503), придут снова.
+    """
+
+    # Как часто (в обработанных апдейтах) сохранять окно
+    PERSIST_EVERY = 20
+    META_KEY = 'update_window'
+
+    def __init__(self, window, path=None):
+        self.window = window
+        self.duplicates = 0
+        self._recent = deque()
+        self._seen = set()
+        self._in_flight = set()
+        self._dirty = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (self.META_KEY,)).fetchone()
+            if row is not None:
+                for update_id in self._decode(row[0])[-window:]:
+                    self._remember(update_id)
+
+    @staticmethod
+    def _encode(update_ids):
+        """Сжимает отсортированные id в диапазоны: '10-15,17,20-21'"""
+        runs = []
+        for update_id in update_ids:
+            if runs and update_id == runs[-1][1] + 1:
+                runs[-1][1] = update_id
+            else:
+                runs.append([update_id, update_id])
+        return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in runs)
+
+    @staticmethod
+    def _decode(value):
+        update_ids = []
+        for run in filter(None, value.split(',')):
+            first, _, last = run.partition('-')
+            update_ids.extend(range(int(first), int(last or first) + 1))
+        return update_ids
+
+    def _remember(self, update_id):
+        if len(self._recent) >= self.window:
+            self._seen.discard(self._recent.popleft())
+        self._recent.append(update_id)
+        self._seen.add(update_id)
+
+    def check(self, update_id):
+        """Запоминает update_id, возвращает True, если он уже встречался"""
+        if update_id in self._seen:
+            self.duplicates += 1
+            return True
+        self._remember(update_id)
+        return False
+
+    def done(self, update_id):
+        """Отмечает апдейт обработанным: теперь его можно сохранить в окне"""
+        self._in_flight.discard(update_id)
+        self._dirty += 1
+        if self._dirty >= self.PERSIST_EVERY:
+            self.flush()
+
+    def flush(self):
+        """Сохраняет окно обработанных update_id"""
+        if self._db is None or not self._dirty:
+            return
+        completed = sorted(u for u in self._recent if u not in self._in_flight)
+        self._db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (self.META_KEY, self._encode(completed))
+        )
+        self._db.commit()
+        self._dirty = 0
+
+    def close(self):
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+
+    async def __call__(self, handler, event, data):
+        if self.check(event.update_id):
+            logging.info(f"Повторная доставка апдейта {event.update_id}, пропускаем")
+            return None
+        self._in_flight.add(event.update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            deferred = data.get('deferred_task')
+            if deferred is None:
+                self.done(event.update_id)
+            else:
+                # Отложенный апдейт остается в обработке, пока не выполнится
+                deferred.add_done_callback(lambda task: self.done(event.update_id))
+
+class LatencyHistogram:
+    """Гистограмма задержек в формате Prometheus с одной меткой.
+
+    На каждое значение метки заранее заводится список счетчиков по
+    корзинам, observe() только увеличивает счетчик и сумму.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._counts = {}  # значение метки -> счетчики по корзинам (+Inf последней)
+        self._sums = {}
+
+    def observe(self, key, seconds):
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.BUCKETS) + 1)
+            self._sums[key] = 0.0
+        counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self._sums[key] += seconds
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} histogram')
+        for key in sorted(self._counts):
+            counts = self._counts[key]
+            total = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{key}",le="{bound}"}} {total}')
+            lines.append(f'{self.name}_sum{{{self.label}="{key}"}} {self._sums[key]}')
+            lines.append(f'{self.name}_count{{{self.label}="{key}"}} {total}')
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет задержку и ошибки каждого вызова Bot API по методам"""
+
+    def __init__(self):
+        self.latency = LatencyHistogram(
+            'bot_api_request_duration_seconds', 'Задержка вызовов Bot API', 'method'
+        )
+        self.errors = {}  # (метод, класс ошибки) -> количество
+        self.inline = {}  # метод -> ответов, отданных прямо в webhook
+
+    def record_inline(self, method):
+        name = method.__api_method__
+        self.inline[name] = self.inline.get(name, 0) + 1
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            key = (name, type(e).__name__)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            raise
+        finally:
+            self.latency.observe(name, time.perf_counter() - started)
+            reply = pending_reply.get()
+            if reply is not None and reply[0] is method:
+                observe_reply(reply)
+
+class UpdateCounter(BaseMiddleware):
+    """Считает апдейты: всего и сейчас в обработке"""
+
+    def __init__(self):
+        self.total = 0
+        self.in_flight = 0
+
+    async def __call__(self, handler, event, data):
+        self.total += 1
+        self.in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            deferred = data.get('deferred_task')
+            if deferred is None:
+                self.in_flight -= 1
+            else:
+                deferred.add_done_callback(self._deferred_done)
+
+    def _deferred_done(self, task):
+        self.in_flight -= 1
+
+class InboundLimiter(BaseMiddleware):
+    """Ограничение входящих сообщений от одного пользователя до обработчиков.
+
+    У каждого пользователя в личке свое ведро токенов: `burst` сообщений
+    подряд, дальше `rate` в секунду. Альбом стоит один токен: его части
+    пропускаются, откладываются до того же момента или отбрасываются
+    вместе с первой. Сообщение сверх лимита
+    либо откладывается до появления токена (если ждать не дольше
+    `max_defer` секунд), либо отбрасывается без обработки, и пользователь
+    один раз за серию получает предупреждение (прямо в ответе на webhook).
+    Задача отложенного сообщения кладется в data['deferred_task']: до ее
+    завершения апдейт считается в обработке у UpdateDeduplicator и
+    UpdateCounter, а UpdatePoller не подтверждает пачку. Полные ведра ничем не отличаются от новых, поэтому периодически
+    выбрасываются из памяти.
+    """
+
+    # Как часто (в секундах) выбрасывать ведра простаивающих пользователей
+    SWEEP_INTERVAL = 60.0
+
+    def __init__(self, rate, burst, max_defer=0.0):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_defer = max_defer
+        self._buckets = {}   # user_id -> TokenBucket
+        self._albums = {}    # user_id -> (media_group_id, когда пропускать части или None)
+        self._warned = set()  # кого уже предупредили в текущей серии
+        self._deferred = set()
+        self._swept_at = time.monotonic()
+        # Счетчики
+        self.shed = 0
+        self.deferred = 0
+        self.warnings = 0
+
+    @property
+    def tracked(self):
+        return len(self._buckets)
+
+    @property
+    def pending(self):
+        """Отложенных сообщений ждут своей очереди"""
+        return len(self._deferred)
+
+    def _sweep(self, now):
+        for user_id in [k for k, bucket in self._buckets.items() if bucket.is_idle(now)]:
+            del self._buckets[user_id]
+            self._albums.pop(user_id, None)
+            self._warned.discard(user_id)
+        self._swept_at = now
+
+    def admit(self, user_id, now, media_group_id=None):
+        """Берет токен пользователя: 0 — можно сразу, >0 — через сколько секунд, None — отбросить"""
+        if now - self._swept_at >= self.SWEEP_INTERVAL:
+            self._sweep(now)
+        if media_group_id is not None:
+            album = self._albums.get(user_id)
+            if album is not None and album[0] == media_group_id:
+                # Части альбома идут не раньше первой: иначе они соберутся
+                # в альбом без нее, а она уйдет отдельным постом
+                return None if album[1] is None else max(0.0, album[1] - now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst, now)
+        delay = bucket.delay(now)
+        if delay > self.max_defer:
+            admitted = None
+        else:
+            # При отсрочке токен берется в долг: следующие сообщения
+            # встанут после этого, и порядок сохранится
+            bucket.take(now)
+            admitted = delay
+        if media_group_id is not None:
+            self._albums[user_id] = (media_group_id, None if admitted is None else now + admitted)
+        return admitted
+
+    async def _run_deferred(self, delay, handler, event, data):
+        await asyncio.sleep(delay)
+        try:
+            result = await handler(event, data)
+            if isinstance(result, TelegramMethod):
+                await data['bot'](result)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке отложенного апдейта {event.update_id}: {e}")
+
+    async def drain(self):
+        """Дожидается отложенных сообщений"""
+        if self._deferred:
+            await asyncio.gather(*self._deferred, return_exceptions=True)
+
+    async def __call__(self, handler, event, data):
+        message = event.message
+        if message is None or message.chat.type != 'private' or message.from_user is None:
+            return await handler(event, data)
+        user_id = message.from_user.id
+        delay = self.admit(user_id, time.monotonic(), message.media_group_id)
+        if delay == 0.0:
+            self._warned.discard(user_id)
+            return await handler(event, data)
+        if delay is not None:
+            self.deferred += 1
+            task = asyncio.create_task(self._run_deferred(delay, handler, event, data))
+            self._deferred.add(task)
+            task.add_done_callback(self._deferred.discard)
+            data['deferred_task'] = task
+            return None
+        self.shed += 1
+        if user_id in self._warned:
+            return None
+        self._warned.add(user_id)
+        self.warnings += 1
+        logging.info(f"Пользователь {user_id} превысил лимит сообщений")
+        return message.answer("⏳ Слишком много сообщений подряд. Подождите немного — следующие сообщения пока не доставляются.")
+
+class ForwardCoalescer:
+    """Копит подряд идущие текстовые сообщения пользователя.
+
+    Пачка уходит в `flush`, когда пользователь молчит `window` секунд или
+    набралось `max_messages` сообщений. Так серия коротких сообщений стоит
+    одного поста в админском чате и одного подтверждения.
+    """
+
+    def __init__(self, window, max_messages, flush):
+        self.window = window
+        self.max_messages = max_messages
+        self.flush = flush
+        self.batches = 0
+        self.merged = 0
+        self._pending = {}  # user_id -> [сообщения]
+        self._timers = {}   # user_id -> TimerHandle
+        self._flushing = {}  # user_id -> последняя запущенная отправка
+        self._tasks = set()
+
+    @property
+    def pending(self):
+        """Сообщений ждут отправки (в пачках и в уже запущенных отправках)"""
+        return sum(len(batch) for batch in self._pending.values()) + len(self._tasks)
+
+    def add(self, message):
+        user_id = message.from_user.id
+        batch = self._pending.setdefault(user_id, [])
+        batch.append(message)
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        delay = 0 if len(batch) >= self.max_messages else self.window
+        self._timers[user_id] = asyncio.get_running_loop().call_later(delay, self._start_flush, user_id)
+
+    def _start_flush(self, user_id):
+        self._timers.pop(user_id, None)
+        batch = self._pending.pop(user_id, None)
+        if batch:
+            # Пачки одного пользователя уходят строго друг за другом
+            task = asyncio.create_task(self._flush(batch, self._flushing.get(user_id)))
+            self._flushing[user_id] = task
+            self._tasks.add(task)
+            task.add_done_callback(lambda task: self._flush_done(user_id, task))
+
+    def _flush_done(self, user_id, task):
+        self._tasks.discard(task)
+        if self._flushing.get(user_id) is task:
+            del self._flushing[user_id]
+
+    async def _flush(self, batch, previous=None):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        self.batches += 1
+        self.merged += len(batch)
+        try:
+            await self.flush(batch)
+        except Exception as e:
+            logging.error(f"Ошибка при отправке пачки сообщений админам: {e}")
+
+    async def flush_user(self, user_id):
+        """Отправляет накопленное пользователем и ждет всех его отправок (перед нетекстовым сообщением)"""
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        self._start_flush(user_id)
+        task = self._flushing.get(user_id)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def drain(self):
+        """Отправляет все накопленные пачки и ждет их отправки"""
+        for user_id in list(self._pending):
+            self._start_flush(user_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+class MediaGroupCollector:
+    """Собирает части альбомов: Telegram присылает каждую отдельным апдейтом.
+
+    Части копятся по media_group_id, и через `window` секунд после последней
+    весь альбом уходит в переданный при добавлении `flush` одним списком.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self._groups = {}  # media_group_id -> [chat_id, сообщения, flush, TimerHandle]
+        self._tasks = set()
+
+    @property
+    def pending(self):
+        return sum(len(group[1]) for group in self._groups.values()) + len(self._tasks)
+
+    def add(self, message, flush):
+        group = self._groups.get(message.media_group_id)
+        if group is None:
+            group = self._groups[message.media_group_id] = [message.chat.id, [], flush, None]
+        else:
+            group[3].cancel()
+        group[1].append(message)
+        group[3] = asyncio.get_running_loop().call_later(self.window, self._start_flush, message.media_group_id)
+
+    def _start_flush(self, media_group_id):
+        group = self._groups.pop(media_group_id, None)
+        if group is not None:
+            group[3].cancel()
+            task = asyncio.create_task(self._flush(group[1], group[2]))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
 
-# Словарь для хранения состояний пользователей (ожидают ли ответа админам)
-waiting_for_admin_message = {}
+    @staticmethod
+    async def _flush(messages, flush):
+        try:
+            await flush(sorted(messages, key=lambda message: message.message_id))
+        except Exception as e:
+            logging.error(f"Ошибка при отправке альбома: {e}")
 
-# Словарь для связывания сообщений админа с пользователями
-# Формат: {message_id_от_бота_в_админ_чате: user_id}
-admin_message_to_user = {}
+    async def flush_chat(self, chat_id):
+        """Сразу отправляет альбомы из чата (перед следующим сообщением)"""
+        for media_group_id in [key for key, group in self._groups.items() if group[0] == chat_id]:
+            group = self._groups.pop(media_group_id)
+            group[3].cancel()
+            await self._flush(group[1], group[2])
 
-# Статистика
-stats = {
-    'total_users': set(),  # Уникальные пользователи
-    'messages_today': 0,   # Сообщения за сегодня
-    'messages_this_week': 0,  # Сообщения за неделю
-    'daily_messages': defaultdict(int),  # По дням
-    'start_time': datetime.now()  # Время запуска бота
-}
+    async def drain(self):
+        for media_group_id in list(self._groups):
+            self._start_flush(media_group_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+class UpdateJob:
+    """Апдейт в очереди пула и ответ обработчика для webhook"""
+
+    __slots__ = ('update', 'reply', 'detached', 'pending_reply')
+
+    def __init__(self, update, reply, detached):
+        self.update = update
+        self.reply = reply        # future с TelegramMethod, который вернул обработчик
+        self.detached = detached  # webhook уже ответил, метод вызываем сами
+        self.pending_reply = None  # значение pending_reply после обработчика
+
+class UpdateWorkerPool:
+    """Ограниченный пул воркеров для апдейтов из webhook.
+
+    У каждого воркера своя очередь, апдейт попадает в очередь по id
+    пользователя, поэтому сообщения одного пользователя обрабатываются
+    строго по порядку. Всего в пуле не больше `high_water` апдейтов.
+    """
+
+    def __init__(self, dispatcher, bot, workers, high_water):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.high_water = high_water
+        self.pending = 0
+        self.shed = 0
+        self.accepting = True
+        self._queues = [asyncio.Queue() for _ in range(workers)]
+        self._tasks = []
+        self._has_room = asyncio.Event()
+        self._has_room.set()
+
+    @staticmethod
+    def _user_key(update):
+        try:
+            event = update.event
+        except UpdateTypeLookupError:
+            # Неизвестный aiogram тип апдейта: диспетчер сам его пропустит
+            return update.update_id
+        user = getattr(event, 'from_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, 'chat', None)
+        return chat.id if chat is not None else update.update_id
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def submit(self, update, block=True, wait_reply=False):
+        """Ставит апдейт в очередь, при переполнении ждет или возвращает None"""
+        while self.accepting and self.pending >= self.high_water:
+            if not block:
+                self.shed += 1
+                return None
+            self._has_room.clear()
+            await self._has_room.wait()
+        if not self.accepting:
+            return None  # Пул останавливается
+        job = UpdateJob(update, asyncio.get_running_loop().create_future(), detached=not wait_reply)
+        self.pending += 1
+        self._queues[hash(self._user_key(update)) % len(self._queues)].put_nowait(job)
+        return job
+
+    async def _handle(self, job):
+        try:
+            result = await self.dispatcher.feed_update(self.bot, job.update)
+            if isinstance(result, TelegramMethod):
+                if job.detached:
+                    await self.dispatcher.silent_call_request(self.bot, result)
+                elif not job.reply.done():
+                    job.pending_reply = pending_reply.get()
+                    job.reply.set_result(result)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке апдейта {job.update.update_id}: {e}")
+
+    async def _worker(self, queue):
+        while True:
+            job = await queue.get()
+            try:
+                # Каждый апдейт в своей задаче, а значит в своей копии контекста:
+                # send_priority, выставленный обработчиком, не достанется следующим
+                await asyncio.create_task(self._handle(job))
+            finally:
+                if not job.reply.done():
+                    job.reply.set_result(None)
+                self.pending -= 1
+                self._has_room.set()
+                queue.task_done()
+
+    async def drain(self):
+        """Перестает принимать апдейты и ждет обработки уже принятых"""
+        self.accepting = False
+        self._has_room.set()
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """Webhook, который сразу отвечает Telegram и отдает апдейт в пул.
+
+    Если обработчик за `reply_timeout` секунд вернул метод (например,
+    `return message.answer(...)`), он уходит прямо в ответе на webhook
+    и экономит один запрос к Bot API. Такой ответ тоже берет токены у
+    SendScheduler; если их нет, он отправляется обычным запросом.
+    """
+
+    def __init__(self, dispatcher, bot, pool, overflow='block', reply_timeout=0.0, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.pool = pool
+        self.overflow = overflow
+        self.reply_timeout = reply_timeout
+        self._detached = set()
+
+    async def _handle_request_background(self, bot, request):
+        update = Update.model_validate(
+            await request.json(loads=bot.session.json_loads),
+            context={'bot': bot}
+        )
+        wait_reply = self.reply_timeout > 0
+        job = await self.pool.submit(update, block=self.overflow != 'shed', wait_reply=wait_reply)
+        if job is None:
+            # Telegram повторит доставку позже
+            if self.pool.accepting:
+                logging.warning(f"Очередь апдейтов переполнена, апдейт {update.update_id} отклонен")
+            else:
+                logging.info(f"Бот останавливается, апдейт {update.update_id} отклонен")
+            return web.Response(status=503)
+        if not wait_reply:
+            return web.json_response({}, dumps=bot.session.json_dumps)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(job.reply), self.reply_timeout)
+        except asyncio.TimeoutError:
+            result = job.reply.result() if job.reply.done() else None
+        if not job.reply.done():
+            job.detached = True
+        if result is not None:
+            if send_scheduler.try_acquire(result):
+                api_metrics.record_inline(result)
+                if job.pending_reply is not None:
+                    observe_reply(job.pending_reply)
+            else:
+                # Лимиты исчерпаны: ответ встанет в очередь планировщика, а время
+                # обработчика запишет ApiMetricsMiddleware после отправки
+                context = copy_context()
+                context.run(pending_reply.set, job.pending_reply)
+                task = asyncio.create_task(self.dispatcher.silent_call_request(bot, result), context=context)
+                self._detached.add(task)
+                task.add_done_callback(self._detached.discard)
+                result = None
+        return web.Response(body=self._build_response_writer(bot=bot, result=result))
+
+    async def drain(self):
+        """Дожидается ответов, которые вместо webhook ушли запросами"""
+        if self._detached:
+            await asyncio.gather(*self._detached, return_exceptions=True)
+
+class UpdatePoller:
+    """Получение апдейтов через long polling пачками getUpdates.
+
+    Пачка раздается в пул воркеров, поэтому разные пользователи
+    обрабатываются параллельно, а сообщения одного — по порядку. Telegram
+    считает апдейты подтвержденными, как только getUpdates пришел с большим
+    offset, поэтому следующая пачка запрашивается только после обработки
+    текущей. После каждой пачки сохраняются окно UpdateDeduplicator и
+    offset в meta: после перезапуска бот продолжает с того же места, а
+    повторы после сбоя посреди пачки отсеиваются по окну.
+    """
+
+    META_KEY = 'polling_offset'
+    # Предельная пауза между повторами getUpdates после ошибок (секунды)
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, dispatcher, bot, pool, limit, timeout):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.pool = pool  # None — без пула, пачка делится по пользователям здесь же
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = 0
+        self._stopping = asyncio.Event()
+        # Счетчики
+        self.batches = 0
+        self.updates = 0
+        self.errors = 0
+
+    def stop(self):
+        """Просит остановиться: текущая пачка дообрабатывается, ожидание getUpdates прерывается"""
+        self._stopping.set()
+
+    async def _fetch(self):
+        """getUpdates, который прерывается остановкой (тогда возвращает None)"""
+        fetch = asyncio.ensure_future(self.bot.get_updates(
+            offset=self.offset or None,
+            limit=self.limit,
+            timeout=self.timeout,
+            request_timeout=self.timeout + 10,
+        ))
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        await asyncio.wait({fetch, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not fetch.done():
+            fetch.cancel()
+            await asyncio.gather(fetch, return_exceptions=True)
+            return None
+        return fetch.result()
+
+    async def _feed(self, update):
+        try:
+            result = await self.dispatcher.feed_update(self.bot, update)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(self.bot, result)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+
+    async def _feed_chain(self, updates):
+        """Обрабатывает апдейты одного пользователя по очереди"""
+        for update in updates:
+            # Своя задача на апдейт, чтобы send_priority не перетекал между апдейтами
+            await asyncio.create_task(self._feed(update))
+
+    async def _process(self, updates):
+        """Обрабатывает пачку целиком, False — пул уже не принимает апдейты"""
+        if self.pool is None:
+            chains = {}
+            for update in updates:
+                chains.setdefault(UpdateWorkerPool._user_key(update), []).append(update)
+            await asyncio.gather(*(self._feed_chain(chain) for chain in chains.values()))
+            return True
+        jobs = [await self.pool.submit(update) for update in updates]
+        await asyncio.gather(*(job.reply for job in jobs if job is not None))
+        return None not in jobs
+
+    async def run(self):
+        saved = await state.get_meta(self.META_KEY)
+        self.offset = int(saved) if saved else 0
+        logging.info(f"Long polling: offset {self.offset}, до {self.limit} апдейтов за запрос")
+        backoff = 1.0
+        while not self._stopping.is_set():
+            try:
+                updates = await self._fetch()
+            except Exception as e:
+                self.errors += 1
+                if isinstance(e, TelegramConflictError):
+                    logging.error(f"getUpdates конфликтует с webhook или другим процессом: {e}")
+                else:
+                    logging.error(f"Ошибка getUpdates: {e}, повтор через {backoff:.0f} с")
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, self.MAX_BACKOFF)
+                continue
+            backoff = 1.0
+            if not updates:
+                continue
+            if not await self._process(updates):
+                break
+            if inbound_limiter is not None:
+                # Отложенные лимитом сообщения пачки еще не обработаны: пока
+                # offset не сдвинут, после сбоя Telegram доставит их снова
+                await inbound_limiter.drain()
+            # Окно сохраняется раньше offset: после сбоя между ними пачка
+            # придет снова и целиком отсеется как повтор
+            update_dedup.flush()
+            self.offset = updates[-1].update_id + 1
+            await state.set_meta(self.META_KEY, str(self.offset))
+            self.batches += 1
+            self.updates += len(updates)
+
+class PreparedMarkupSession(AiohttpSession):
+    """Сессия, которая берет заранее сериализованные клавиатуры.
+
+    Обычно reply_markup заново превращается в JSON при каждом запросе,
+    а для клавиатур, переданных в prepare_markup, JSON готовится один раз.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prepared_markups = {}  # id(клавиатуры) -> JSON
+
+    def prepare_markup(self, markup):
+        self.prepared_markups[id(markup)] = self.prepare_value(
+            markup.model_dump(warnings=False), bot=None, files={}
+        )
+
+    def build_form_data(self, bot, method):
+        prepared = self.prepared_markups.get(id(getattr(method, 'reply_markup', None)))
+        if prepared is None:
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={'reply_markup'}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if not value:
+                continue
+            form.add_field(key, value)
+        form.add_field('reply_markup', prepared)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+class PooledSession(PreparedMarkupSession):
+    """Сессия с настроенным пулом соединений и прогревом.
+
+    Соединения с Bot API живут BOT_API_KEEPALIVE секунд, адрес кэшируется
+    на BOT_API_DNS_TTL, а prewarm() заранее открывает несколько соединений,
+    чтобы первые ответы после холодного старта не ждали DNS и TLS.
+    Счетчики opened/reused показывают, сколько запросов пошло по новому
+    соединению, а сколько по уже открытому.
+    """
+
+    def __init__(self, pool_size, keepalive, dns_ttl, **kwargs):
+        super().__init__(limit=pool_size, **kwargs)
+        self._connector_init['keepalive_timeout'] = keepalive
+        self._connector_init['ttl_dns_cache'] = dns_ttl
+        self.opened = 0
+        self.reused = 0
+        self._trace = TraceConfig()
+        self._trace.on_connection_create_end.append(self._on_opened)
+        self._trace.on_connection_reuseconn.append(self._on_reused)
+
+    async def _on_opened(self, session, context, params):
+        self.opened += 1
+
+    async def _on_reused(self, session, context, params):
+        self.reused += 1
+
+    async def create_session(self):
+        if self._should_reset_connector:
+            await self.close()
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=self._connector_type(**self._connector_init),
+                headers={'User-Agent': f'{SERVER_SOFTWARE} aiogram/{aiogram_version}'},
+                trace_configs=[self._trace],
+            )
+            self._should_reset_connector = False
+        return self._session
+
+    @property
+    def idle_connections(self):
+        """Открытых соединений в пуле, ожидающих запроса (None — aiohttp не дает узнать)"""
+        if self._session is None or self._session.closed:
+            return 0
+        # Публичного счетчика у aiohttp нет, а _conns может измениться в новой версии
+        conns = getattr(self._session.connector, '_conns', None)
+        if not isinstance(conns, dict):
+            return None
+        return sum(len(connections) for connections in conns.values())
+
+    async def prewarm(self, count):
+        """Открывает count соединений с сервером Bot API и оставляет их в пуле"""
+        if count <= 0:
+            return
+        parsed = urlparse(self.api.api_url(token='', method=''))
+        origin = f'{parsed.scheme}://{parsed.netloc}/'
+        session = await self.create_session()
+
+        async def touch():
+            # Ответ не важен: нужно только соединение, которое вернется в пул
+            async with session.head(origin, allow_redirects=False, timeout=ClientTimeout(total=10)):
+                pass
 
-bot = Bot(token=BOT_TOKEN)
+        started = time.perf_counter()
+        results = await asyncio.gather(*(touch() for _ in range(count)), return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        logging.info(
+            f"Прогрев Bot API: {count - failed}/{count} соединений за "
+            f"{(time.perf_counter() - started) * 1000:.0f} мс"
+        )
+
+session_kwargs = {'api': TelegramAPIServer.from_base(BOT_API_URL)} if BOT_API_URL else {}
+bot = Bot(
+    token=BOT_TOKEN,
+    session=PooledSession(BOT_API_POOL_SIZE, BOT_API_KEEPALIVE, BOT_API_DNS_TTL, **session_kwargs)
+)
+bot.session.middleware(send_scheduler)
+# Замер стоит после планировщика и видит только сам HTTP-запрос
+api_metrics = ApiMetricsMiddleware()
+bot.session.middleware(api_metrics)
 dp = Dispatcher()
 
-def update_stats(user_id):
-    """Обновляет статистику при новом сообщении"""
-    now = datetime.now()
-    today = now.date()
-    
-    # Добавляем пользователя в уникальные
-    stats['total_users'].add(user_id)
-    
-    # Увеличиваем счетчики
-    stats['daily_messages'][today] += 1
-    
-    # Пересчитываем сегодняшние сообщения
-    stats['messages_today'] = stats['daily_messages'][today]
-    
-    # Пересчитываем сообщения за неделю
-    week_ago = today - timedelta(days=7)
-    stats['messages_this_week'] = sum(
-        count for date, count in stats['daily_messages'].items() 
-        if date >= week_ago
-    )
+# Отсев повторных доставок стоит перед всеми обработчиками
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, BOT_DB_PATH if UPDATE_DEDUP_PERSIST else None)
+dp.update.outer_middleware(update_dedup)
+update_counter = UpdateCounter()
+dp.update.outer_middleware(update_counter)
+# Лимит на пользователя стоит до журнала и обработчиков: лишнее отсекается сразу
+# При склейке текстов лишние сообщения не теряются, а ждут токена (не дольше
+# времени, за которое ведро наполняется заново) и уходят в ту же пачку
+inbound_limiter = InboundLimiter(
+    INBOUND_RATE, INBOUND_BURST, max_defer=INBOUND_BURST / INBOUND_RATE if FORWARD_COALESCE_SECONDS > 0 else 0.0
+) if INBOUND_RATE > 0 else None
+if inbound_limiter is not None:
+    dp.update.outer_middleware(inbound_limiter)
+
+def classify_message(message: types.Message):
+    """Тип события для журнала"""
+    if str(message.chat.id) == ADMIN_GROUP_ID:
+        return EVENT_ADMIN
+    text = message.text
+    if text:
+        if text in BUTTON_ROUTES:
+            return EVENT_BUTTON
+        if text.startswith('/start'):
+            return EVENT_START
+        if text[0] == '/':
+            return EVENT_COMMAND
+    return EVENT_MESSAGE
+
+async def log_event(handler, event, data):
+    """Пишет каждое сообщение в журнал событий"""
+    message = event.message
+    if message is not None and message.from_user is not None:
+        event_log.append(message.from_user.id, classify_message(message))
+    return await handler(event, data)
+
+# Журнал событий (None — выключен)
+event_log = EventLog(EVENT_LOG_DIR, BOT_DB_PATH) if EVENT_LOG_DIR else None
+if event_log is not None:
+    dp.update.outer_middleware(log_event)
+
+# Задержка обработчиков для /metrics: вместе с отправкой ответа, в том
+# числе метода, который обработчик вернул, а не вызвал сам
+handler_latency = LatencyHistogram(
+    'bot_handler_duration_seconds', 'Задержка обработки сообщений вместе с отправкой ответа', 'handler'
+)
+
+def observe_reply(reply):
+    """Записывает время обработчика, чей ответ (значение pending_reply) отправлен"""
+    _, name, started = reply
+    handler_latency.observe(name, time.perf_counter() - started)
+
+# Пул обработки апдейтов из webhook
+update_pool = UpdateWorkerPool(dp, bot, workers=WEBHOOK_WORKERS, high_water=WEBHOOK_HIGH_WATER)
+update_poller = UpdatePoller(
+    dp, bot, update_pool if WEBHOOK_WORKERS > 0 else None, limit=POLLING_LIMIT, timeout=POLLING_TIMEOUT
+)
+
+# Клавиатуры неизменяемые, поэтому создаются один раз при импорте
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📤 Отправить данные")],
+        [KeyboardButton(text="📰 Сообщить новость")],
+        [KeyboardButton(text="✍️ Написать админам")]
+    ],
+    resize_keyboard=True,  # Подгоняет размер кнопок
+    one_time_keyboard=False,  # Клавиатура остается после нажатия
+    persistent=True  # Клавиатура всегда видна
+)
+
+ADMIN_CHAT_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="❌ Закончить общение")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    persistent=True
+)
+
+# И сериализуются тоже один раз: сессия подставляет готовый JSON
+bot.session.prepare_markup(MAIN_KEYBOARD)
+bot.session.prepare_markup(ADMIN_CHAT_KEYBOARD)
 
 def get_main_keyboard():
-    """Создает основную клавиатуру с кнопками"""
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📤 Отправить данные")],
-            [KeyboardButton(text="📰 Сообщить новость")],
-            [KeyboardButton(text="✍️ Написать админам")]
-        ],
-        resize_keyboard=True,  # Подгоняет размер кнопок
-        one_time_keyboard=False,  # Клавиатура остается после нажатия
-        persistent=True  # Клавиатура всегда видна
-    )
-    return keyboard
+    """Возвращает основную клавиатуру с кнопками"""
+    return MAIN_KEYBOARD
 
 def get_admin_chat_keyboard():
-    """Создает клавиатуру для режима общения с админами"""
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="❌ Закончить общение")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-        persistent=True
-    )
-    return keyboard
+    """Возвращает клавиатуру для режима общения с админами"""
+    return ADMIN_CHAT_KEYBOARD
 
-@dp.message(CommandStart())
 async def start_handler(message: types.Message):
     """Обработчик команды /start"""
     # Работаем только в личных чатах
@@ -100,59 +2151,117 @@ async def start_handler(message: types.Message):
         return
     
     # Обновляем статистику
-    update_stats(message.from_user.id)
+    await state.record_message(message.from_user.id)
         
-    await message.answer(
+    return message.answer(
         "Привет! 👋\n\nВыберите действие:",
         reply_markup=get_main_keyboard()
     )
 
-@dp.message(Command('stats'))
-async def stats_handler(message: types.Message):
-    """Обработчик команды /stats - только для админов"""
-    # Проверяем, что это админ (сообщение из админского чата или от админа)
-    is_admin = (
+def is_admin(message: types.Message):
+    """Проверяет, что это админ (сообщение из админского чата или от админа)"""
+    return (
         str(message.chat.id) == ADMIN_GROUP_ID or  # Сообщение из админской группы
         str(message.from_user.id) == ADMIN_GROUP_ID.replace('-', '')  # Личное сообщение от админа
     )
-    
-    if not is_admin:
+
+def parse_stats_period(argument, today):
+    """Разбирает '30d', '2026-09' или '2026-09-15' в (первый день, последний день)"""
+    match = re.fullmatch(r'(\d+)d', argument)
+    if match and int(match.group(1)) > 0:
+        return today - timedelta(days=int(match.group(1)) - 1), today
+    match = re.fullmatch(r'(\d{4})-(\d{2})', argument)
+    if match:
+        first = date(int(match.group(1)), int(match.group(2)), 1)
+        following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+        return first, following - timedelta(days=1)
+    day = date.fromisoformat(argument)
+    return day, day
+
+def period_stats_text(argument):
+    """Отчет /stats за период по сводным таблицам журнала событий"""
+    if event_log is None:
+        return "Журнал событий выключен (EVENT_LOG_DIR)."
+    try:
+        first, last = parse_stats_period(argument, datetime.now().date())
+    except (ValueError, OverflowError):
+        return "Период: 30d, 2026-09 или 2026-09-15."
+    started = time.perf_counter()
+    report = event_log.report(first, last)
+    elapsed = (time.perf_counter() - started) * 1000
+    by_kind = report['by_kind']
+    top_senders = [f"  {user_id}: {count}" for user_id, count in report['top_senders']] or ["  —"]
+    busiest_hours = [
+        f"  {hour:02d}:00–{(hour + 1) % 24:02d}:00: {count}" for hour, count in report['busiest_hours']
+    ] or ["  —"]
+    return f"""📊 **Статистика за {first.strftime('%d.%m.%Y')}–{last.strftime('%d.%m.%Y')}**
+
+👥 **Пользователей:** {report['users']}
+📨 **Сообщений пользователей:** {by_kind.get(EVENT_MESSAGE, 0)}
+🚀 **/start:** {by_kind.get(EVENT_START, 0)}
+🔘 **Нажатий кнопок:** {by_kind.get(EVENT_BUTTON, 0)}
+🛡 **Сообщений в админском чате:** {by_kind.get(EVENT_ADMIN, 0)}
+
+🏆 **Самые активные пользователи:**
+{chr(10).join(top_senders)}
+
+🕐 **Самые загруженные часы:**
+{chr(10).join(busiest_hours)}
+
+⚡ Отчет за {elapsed:.1f} мс"""
+
+async def stats_handler(message: types.Message):
+    """Обработчик команды /stats - только для админов"""
+    if not is_admin(message):
         return  # Игнорируем команду от обычных пользователей
     
+    # /stats 30d, /stats 2026-09, /stats 2026-09-15 — отчет за период из журнала
+    parts = message.text.split(maxsplit=1)
+    if len(parts) > 1:
+        return message.answer(period_stats_text(parts[1].strip()), parse_mode='Markdown')
+    
     # Формируем статистику
-    uptime = datetime.now() - stats['start_time']
+    snapshot = await state.stats_snapshot()
+    uptime = datetime.now() - started_at
     uptime_str = f"{uptime.days} дн. {uptime.seconds // 3600} ч. {(uptime.seconds % 3600) // 60} мин."
     
     # Последние 7 дней
     recent_days = []
-    for i in range(6, -1, -1):  # От 6 дней назад до сегодня
-        day = datetime.now().date() - timedelta(days=i)
-        count = stats['daily_messages'].get(day, 0)
-        day_name = "Сегодня" if i == 0 else f"{day.strftime('%d.%m')}"
+    today = datetime.now().date()
+    for day, count in snapshot['recent_days']:
+        day_name = "Сегодня" if day == today else f"{day.strftime('%d.%m')}"
         recent_days.append(f"  {day_name}: {count}")
     
+    avg_wait = send_scheduler.wait_total / send_scheduler.delayed if send_scheduler.delayed else 0.0
+    shed_text = (
+        f"\n🚧 **Отброшено лимитом:** {inbound_limiter.shed} (отложено {inbound_limiter.deferred}, предупреждений {inbound_limiter.warnings})"
+        if inbound_limiter is not None else ""
+    )
+    
     stats_text = f"""📊 **Статистика бота**
 
-👥 **Уникальные пользователи:** {len(stats['total_users'])}
-📨 **Сообщений сегодня:** {stats['messages_today']}
-📈 **Сообщений за неделю:** {stats['messages_this_week']}
+👥 **Уникальные пользователи:** {snapshot['total_users']}
+📨 **Сообщений сегодня:** {snapshot['today']}
+🕐 **Сообщений за 24 часа:** {snapshot['last_24h']}
+📈 **Сообщений за неделю:** {snapshot['week']}
 
 📅 **По дням:**
 {chr(10).join(recent_days)}
 
+📮 **Очередь отправки:** {send_scheduler.queue_depth} (отложено {send_scheduler.delayed}, среднее ожидание {avg_wait:.2f} с, макс. {send_scheduler.wait_max:.2f} с, повторов {send_scheduler.retries}){shed_text}
+
 ⏱️ **Время работы:** {uptime_str}
-🚀 **Запущен:** {stats['start_time'].strftime('%d.%m.%Y %H:%M')}"""
+🚀 **Запущен:** {started_at.strftime('%d.%m.%Y %H:%M')}"""
     
-    await message.answer(stats_text, parse_mode='Markdown')
+    return message.answer(stats_text, parse_mode='Markdown')
 
-@dp.message(lambda message: message.text == "📤 Отправить данные")
 async def send_file_handler(message: types.Message):
     """Обработчик кнопки 'Отправить данные'"""
     # Работаем только в личных чатах
     if message.chat.type != 'private':
         return
         
-    await message.answer(
+    return message.answer(
         "Чтобы опубликовать ваши новеллы, нам нужна информация.\n\n<b>Заполните 2 формы:</b>\n"
         "1. Анкету по новеллам: https://tally.so/r/3qQZg2\n"
         "2. Карточку переводчика: https://tally.so/r/wAexoN\n\n"
@@ -162,21 +2271,19 @@ async def send_file_handler(message: types.Message):
         reply_markup=get_main_keyboard()
     )
 
-@dp.message(lambda message: message.text == "📰 Сообщить новость")
 async def news_handler(message: types.Message):
     """Обработчик кнопки 'Сообщить новость'"""
     # Работаем только в личных чатах
     if message.chat.type != 'private':
         return
         
-    await message.answer(
+    return message.answer(
         "Здесь вы можете сообщить любую новость. Например, что взяли новый перевод или закончили текущий.\n\n"
         "Чтобы отправить новость, заполните анкету: https://tally.so/r/wkBjBd",
         disable_web_page_preview=True,
         reply_markup=get_main_keyboard()
     )
 
-@dp.message(lambda message: message.text == "✍️ Написать админам")
 async def contact_admin_handler(message: types.Message):
     """Обработчик кнопки 'Написать админам'"""
     # Работаем только в личных чатах
@@ -184,18 +2291,15 @@ async def contact_admin_handler(message: types.Message):
         return
     
     # Помечаем пользователя как ожидающего ввода сообщения для админов
-    waiting_for_admin_message[message.from_user.id] = True
-    
-    # Обновляем статистику
-    update_stats(message.from_user.id)
+    # и обновляем статистику
+    await state.record_message(message.from_user.id, waiting=True)
         
-    await message.answer(
+    return message.answer(
         "💬 Режим общения с админами активирован!\n"
         "Теперь все ваши сообщения будут пересылаться админам.",
         reply_markup=get_admin_chat_keyboard()
     )
 
-@dp.message(lambda message: message.text == "❌ Закончить общение")
 async def end_admin_chat_handler(message: types.Message):
     """Обработчик кнопки 'Закончить общение'"""
     # Работаем только в личных чатах
@@ -203,235 +2307,855 @@ async def end_admin_chat_handler(message: types.Message):
         return
     
     # Убираем пометку ожидания сообщений для админов
-    waiting_for_admin_message[message.from_user.id] = False
+    await state.set_waiting(message.from_user.id, False)
         
-    await message.answer(
+    return message.answer(
         "✅ Общение с админами закончено.",
         reply_markup=get_main_keyboard()
     )
 
+class BroadcastRunner:
+    """Рассылка одного сообщения всем известным пользователям.
+
+    Пользователи читаются из хранилища страницами по возрастанию id и
+    обрабатываются пачками по `concurrency`. После каждого пользователя
+    задание с прогрессом (последний id до текущей пачки и уже обработанные
+    в ней) сохраняется в meta, поэтому после перезапуска рассылка продолжается
+    с того же места без повторов. Ведет рассылку один процесс — тот, у кого
+    аренда в хранилище; остальные (и перезапущенный после сбоя процесс, пока
+    не истекла аренда прежнего) ждут ее и подхватывают незавершенное задание.
+    Темп задает SendScheduler, у рассылки самый низкий приоритет.
+    """
+
+    META_KEY = 'broadcast'
+    STOP_KEY = 'broadcast_stop'  # флаг остановки для процесса, который ведет рассылку
+    LEASE = 'broadcast'
+    LEASE_TTL = 60.0
+
+    def __init__(self, concurrency, progress_interval):
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self.job = None
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self._task = None
+        self._waiting = None  # ожидание аренды для незавершенного задания
+        self._reported_at = 0.0
+        self._leased_at = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def active(self):
+        """Идет ли рассылка в этом или другом процессе"""
+        if self.running:
+            return True
+        raw = await state.get_meta(self.META_KEY)
+        return raw is not None and json.loads(raw)['status'] == 'running'
+
+    async def start(self, job, resume=False):
+        """Запускает задание; False — рассылку уже ведет другой процесс
+
+        Для нового задания сначала отправляет сообщение с прогрессом в
+        job['progress_chat_id'].
+        """
+        if not await state.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL):
+            return False
+        self._leased_at = time.monotonic()
+        job.setdefault('done', [])
+        self.job = job
+        if not resume:
+            # Флаг остановки относится к прошлому заданию; при продолжении
+            # его не сбрасываем — остановку могли попросить до перезапуска
+            try:
+                await state.set_meta(self.STOP_KEY, '0')
+                progress = await bot.send_message(job['progress_chat_id'], f"📣 Рассылка идет: 0/{job['total']}")
+            except BaseException:
+                await state.release_lease(self.LEASE, self.owner)
+                raise
+            job['progress_message_id'] = progress.message_id
+        await self._save()
+        self._task = asyncio.create_task(self._run())
+        return True
+
+    async def _try_resume(self):
+        """Продолжает задание, если оно есть; False — аренда еще занята"""
+        raw = await state.get_meta(self.META_KEY)
+        if raw is None:
+            return True
+        job = json.loads(raw)
+        if job['status'] != 'running':
+            return True
+        if not await self.start(job, resume=True):
+            return False
+        logging.info(f"Продолжаем рассылку после пользователя {job['last_user_id']}")
+        return True
+
+    async def _wait_lease(self):
+        while True:
+            await asyncio.sleep(self.LEASE_TTL / 3)
+            try:
+                if await self._try_resume():
+                    return
+            except Exception as e:
+                logging.error(f"Не удалось продолжить рассылку: {e}")
+
+    async def resume(self):
+        """Продолжает рассылку, прерванную перезапуском.
+
+        Если аренда занята (рассылку ведет другой процесс или еще не истекла
+        аренда упавшего), пробует снова, пока задание не завершится.
+        """
+        if not await self._try_resume():
+            logging.info("Рассылку ведет другой процесс, ждем освобождения аренды")
+            self._waiting = asyncio.create_task(self._wait_lease())
+
+    async def stop(self):
+        if self.running:
+            self.job['status'] = 'stopped'
+            return
+        # Рассылку ведет другой процесс: он увидит флаг после пачки, а
+        # процесс, который продолжит ее после сбоя, — до первой пачки
+        await state.set_meta(self.STOP_KEY, '1')
+        if not await state.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL):
+            return
+        # Аренда свободна — задание никто не ведет, останавливаем его сами
+        try:
+            raw = await state.get_meta(self.META_KEY)
+            job = json.loads(raw) if raw is not None else None
+            if job is not None and job['status'] == 'running':
+                job['status'] = 'stopped'
+                self.job = job
+                await self._save()
+                await self._report(final=True)
+        finally:
+            await state.release_lease(self.LEASE, self.owner)
+
+    async def close(self):
+        """Прерывает задачу, не меняя статус: после запуска рассылка продолжится"""
+        if self._waiting is not None:
+            self._waiting.cancel()
+            await asyncio.gather(self._waiting, return_exceptions=True)
+            self._waiting = None
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            # Прогресс по уже отправленным в прерванной пачке
+            await self._save()
+            await state.release_lease(self.LEASE, self.owner)
+
+    async def _renew_lease(self):
+        """Продлевает аренду, False — ее забрал другой процесс"""
+        if time.monotonic() - self._leased_at < self.LEASE_TTL / 3:
+            return True
+        self._leased_at = time.monotonic()
+        return await state.acquire_lease(self.LEASE, self.owner, self.LEASE_TTL)
+
+    async def _save(self):
+        await state.set_meta(self.META_KEY, json.dumps(self.job))
+
+    async def _send(self, user_id):
+        job = self.job
+        try:
+            if job['message_id']:
+                await bot.copy_message(chat_id=user_id, from_chat_id=job['from_chat_id'], message_id=job['message_id'])
+            else:
+                await bot.send_message(chat_id=user_id, text=job['text'])
+            job['sent'] += 1
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота — больше ему не пишем
+            job['blocked'] += 1
+            await state.remove_user(user_id)
+        except Exception as e:
+            job['failed'] += 1
+            logging.warning(f"Рассылка: не удалось отправить {user_id}: {e}")
+        job['done'].append(user_id)
+        await self._save()
+
+    async def _process(self, chunk):
+        """Рассылает пачку, False — аренду забрал другой процесс"""
+        await asyncio.gather(*(self._send(user_id) for user_id in chunk))
+        self.job['last_user_id'] = chunk[-1]
+        self.job['done'] = []
+        await self._save()
+        await self._report()
+        if await state.get_meta(self.STOP_KEY) == '1':
+            self.job['status'] = 'stopped'
+        return await self._renew_lease()
+
+    async def _run(self):
+        send_priority.set(PRIORITY_BROADCAST)
+        job = self.job
+        # Кому уже отправили в пачке, прерванной перезапуском
+        skip = set(job['done'])
+        chunk = []
+        leased = True
+        try:
+            # Остановку могли попросить, пока задание никто не вел
+            if await state.get_meta(self.STOP_KEY) == '1':
+                job['status'] = 'stopped'
+            users = state.iter_users(after=job['last_user_id'])
+            async for user_id in users:
+                if job['status'] != 'running':
+                    break
+                if user_id in skip:
+                    continue
+                chunk.append(user_id)
+                if len(chunk) >= self.concurrency:
+                    leased = await self._process(chunk)
+                    chunk = []
+                    if job['status'] != 'running' or not leased:
+                        break
+            await users.aclose()
+            if chunk and job['status'] == 'running' and leased:
+                leased = await self._process(chunk)
+            if job['status'] == 'running' and leased:
+                job['status'] = 'done'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка рассылки: {e}")
+            job['status'] = 'failed'
+        if not leased:
+            logging.warning("Аренду рассылки забрал другой процесс, останавливаемся")
+            return
+        await self._save()
+        await state.release_lease(self.LEASE, self.owner)
+        await self._report(final=True)
+
+    async def _report(self, final=False):
+        """Обновляет сообщение с прогрессом, не чаще progress_interval"""
+        now = time.monotonic()
+        if not final and now - self._reported_at < self.progress_interval:
+            return
+        self._reported_at = now
+        job = self.job
+        done = job['sent'] + job['blocked'] + job['failed']
+        status = {
+            'running': "идет", 'done': "завершена", 'stopped': "остановлена", 'failed': "прервана ошибкой",
+        }[job['status']]
+        try:
+            await bot.edit_message_text(
+                chat_id=job['progress_chat_id'],
+                message_id=job['progress_message_id'],
+                text=f"📣 Рассылка {status}: {done}/{job['total']}\n"
+                     f"✅ Доставлено: {job['sent']}\n"
+                     f"🚫 Заблокировали бота: {job['blocked']}\n"
+                     f"⚠️ Ошибок: {job['failed']}"
+            )
+        except TelegramBadRequest:
+            pass  # Текст не изменился или сообщение удалено
+
+broadcast = BroadcastRunner(BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_SECONDS)
+
+async def broadcast_handler(message: types.Message):
+    """Обработчик команды /broadcast - рассылка всем пользователям, только для админов"""
+    if not is_admin(message):
+        return  # Игнорируем команду от обычных пользователей
+    
+    parts = message.text.split(maxsplit=1)
+    argument = parts[1].strip() if len(parts) > 1 else ''
+    
+    if argument == 'stop':
+        if not await broadcast.active():
+            return message.reply("Рассылка не идет.")
+        await broadcast.stop()
+        return message.reply("⏹ Останавливаем рассылку...")
+    
+    if await broadcast.active():
+        return message.reply("⏳ Рассылка уже идет. Остановить: /broadcast stop")
+    
+    # Рассылаем либо сообщение, на которое ответили, либо текст после команды
+    if not message.reply_to_message and not argument:
+        return message.reply(
+            "Использование:\n"
+            "/broadcast текст — разослать текст всем пользователям\n"
+            "/broadcast ответом на сообщение — разослать это сообщение\n"
+            "/broadcast stop — остановить рассылку"
+        )
+    
+    # Сообщение с прогрессом отправит start(), когда получит аренду
+    started = await broadcast.start({
+        'status': 'running',
+        'text': argument,
+        'from_chat_id': message.chat.id,
+        'message_id': message.reply_to_message.message_id if message.reply_to_message else None,
+        'progress_chat_id': message.chat.id,
+        'progress_message_id': None,
+        'total': await state.count_users(),
+        'last_user_id': 0,
+        'sent': 0,
+        'blocked': 0,
+        'failed': 0,
+        'done': [],
+    })
+    if not started:
+        return message.reply("⏳ Рассылка уже идет. Остановить: /broadcast stop")
+
+# Кнопки и команды разбираются одним поиском в словаре вместо цепочки фильтров
+BUTTON_ROUTES = {
+    "📤 Отправить данные": send_file_handler,
+    "📰 Сообщить новость": news_handler,
+    "✍️ Написать админам": contact_admin_handler,
+    "❌ Закончить общение": end_admin_chat_handler,
+}
+
+COMMAND_ROUTES = {
+    '/start': start_handler,
+    '/stats': stats_handler,
+    '/broadcast': broadcast_handler,
+}
+
+# Username бота, заполняется при запуске (для команд вида /stats@bot)
+bot_username = None
+
+def route_message(message: types.Message):
+    """Фильтр-маршрутизатор: находит обработчик кнопки или команды"""
+    text = message.text
+    if not text:
+        return False
+    route = BUTTON_ROUTES.get(text)
+    if route is None and text[0] == '/':
+        command, _, mention = text.split(maxsplit=1)[0].partition('@')
+        if mention and bot_username and mention.lower() != bot_username.lower():
+            return False
+        route = COMMAND_ROUTES.get(command)
+    if route is None:
+        return False
+    return {'route': route}
+
+@dp.message(route_message)
+async def route_handler(message: types.Message, route):
+    """Вызывает обработчик, найденный маршрутизатором"""
+    started = time.perf_counter()
+    result = await route(message)
+    if isinstance(result, TelegramMethod):
+        # Ответ уйдет позже, в ответе на webhook или запросом к Bot API:
+        # время запишется после отправки, как у веток, которые шлют сами
+        pending_reply.set((result, route.__name__, started))
+    else:
+        handler_latency.observe(route.__name__, time.perf_counter() - started)
+    return result
+
+# Типы сообщений без подписи: заголовок к ним уходит отдельным сообщением
+CAPTIONLESS_TYPES = {'sticker', 'video_note', 'dice', 'location', 'venue', 'contact', 'poll'}
+
+# Что пользователь может отправить админам и как это подписать
+USER_CONTENT_LABELS = {
+    'text': "📝 Сообщение",
+    'sticker': "🎭 Отправил стикер",
+    'animation': "🎬 Отправил гифку",
+    'photo': "🖼 Отправил фото",
+    'video': "🎥 Отправил видео",
+    'voice': "🎤 Отправил голосовое",
+    'video_note': "⭕ Отправил видеосообщение",
+    'audio': "🎵 Отправил аудио",
+    'document': "📎 Отправил файл",
+}
+
+# Максимальная длина текста сообщения и подписи к медиа в Telegram
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+ADMIN_REPLY_HEADER = "💬 Ответ от админов"
+
+def _with_header(header, body):
+    return f"{header}:\n\n{body}" if body else header
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """Режет текст на части не длиннее limit символов"""
+    return [text[start:start + limit] for start in range(0, len(text), limit)] or [text]
+
+async def relay_message(message: types.Message, chat_id, header, reply_markup=None):
+    """Копирует сообщение в chat_id с заголовком, по возможности одним вызовом.
+
+    Текст уходит через sendMessage, медиа — через copyMessage с заголовком
+    в подписи. Длинный текст делится на несколько сообщений. Заголовок идет
+    отдельным сообщением у типов без подписи (стикеры и т.п.) и когда с ним
+    подпись не влезает в лимит. Возвращает message_id отправленных сообщений.
+    """
+    if message.text is not None:
+        parts = split_text(_with_header(header, message.text))
+        message_ids = []
+        for index, part in enumerate(parts):
+            # Клавиатура — у последней части
+            markup = reply_markup if index == len(parts) - 1 else None
+            result = await bot.send_message(chat_id=chat_id, text=part, reply_markup=markup)
+            message_ids.append(result.message_id)
+        return message_ids
+    caption = _with_header(header, message.caption)
+    if message.content_type in CAPTIONLESS_TYPES or len(caption) > CAPTION_LIMIT:
+        first = await bot.send_message(chat_id=chat_id, text=header, reply_markup=reply_markup)
+        result = await bot.copy_message(chat_id=chat_id, from_chat_id=message.chat.id, message_id=message.message_id)
+        return [first.message_id, result.message_id]
+    result = await bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=message.chat.id,
+        message_id=message.message_id,
+        caption=caption,
+        reply_markup=reply_markup
+    )
+    return [result.message_id]
+
+# Как собрать элемент альбома из сообщения
+ALBUM_MEDIA = {
+    'photo': lambda message, caption: InputMediaPhoto(media=message.photo[-1].file_id, caption=caption),
+    'video': lambda message, caption: InputMediaVideo(media=message.video.file_id, caption=caption),
+    'document': lambda message, caption: InputMediaDocument(media=message.document.file_id, caption=caption),
+    'audio': lambda message, caption: InputMediaAudio(media=message.audio.file_id, caption=caption),
+}
+
+async def relay_album(messages, chat_id, header):
+    """Отправляет альбом одним sendMediaGroup, заголовок — в подписи первого элемента"""
+    messages = [message for message in messages if message.content_type in ALBUM_MEDIA]
+    if len(messages) < 2:
+        # sendMediaGroup принимает от 2 элементов
+        message_ids = []
+        for message in messages:
+            message_ids.extend(await relay_message(message, chat_id, header))
+        return message_ids
+    message_ids = []
+    first_caption = _with_header(header, messages[0].caption)
+    if len(first_caption) > CAPTION_LIMIT:
+        # С заголовком подпись не влезает — заголовок уходит отдельно
+        result = await bot.send_message(chat_id=chat_id, text=header)
+        message_ids.append(result.message_id)
+        first_caption = messages[0].caption
+    media = [
+        ALBUM_MEDIA[message.content_type](message, first_caption if index == 0 else message.caption)
+        for index, message in enumerate(messages)
+    ]
+    results = await bot.send_media_group(chat_id=chat_id, media=media)
+    return message_ids + [result.message_id for result in results]
+
+async def relay_admin_reply(message: types.Message):
+    """Отправляет пользователю ответ админа из админского чата"""
+    # Ищем пользователя для ответа
+    original_message_id = message.reply_to_message.message_id
+    target_user_id = await state.get_link(original_message_id)
+    
+    if not target_user_id:
+        await message.reply("❌ Отвечайте именно на стикер.")
+        return
+    
+    # Ответы админов уходят раньше остальных запросов
+    send_priority.set(PRIORITY_ADMIN_REPLY)
+    
+    # Альбом собирается целиком и уходит одним запросом
+    if message.media_group_id:
+        async def send_album(messages):
+            try:
+                await relay_album(messages, target_user_id, ADMIN_REPLY_HEADER)
+                await messages[0].reply("✅ Ответ отправлен пользователю!")
+            except Exception as e:
+                logging.error(f"Ошибка при отправке ответа пользователю: {e}")
+                await messages[0].reply("❌ Ошибка при отправке ответа.")
+        media_groups.add(message, send_album)
+        return
+    
+    try:
+        # Определяем клавиатуру для пользователя
+        keyboard = get_admin_chat_keyboard() if await state.is_waiting(target_user_id) else get_main_keyboard()
+        
+        # Копируем ответ пользователю
+        await relay_message(message, target_user_id, ADMIN_REPLY_HEADER, reply_markup=keyboard)
+        
+        # Подтверждаем админу
+        await message.reply("✅ Ответ отправлен пользователю!")
+        
+        # НЕ удаляем связь - теперь можно отвечать много раз на одно сообщение
+        # del state.links[original_message_id]
+        
+    except Exception as e:
+        logging.error(f"Ошибка при отправке ответа пользователю: {e}")
+        await message.reply("❌ Ошибка при отправке ответа.")
+
+def format_user_info(user):
+    """Подпись с данными пользователя для админского чата"""
+    user_info = f"👤 Пользователь: {user.full_name}"
+    if user.username:
+        user_info += f" (@{user.username})"
+    user_info += f"\n🆔 ID: {user.id}"
+    return user_info
+
+async def forward_batch_to_admins(messages):
+    """Отправляет админам пачку текстов одного пользователя одним постом"""
+    first = messages[0]
+    user_id = first.from_user.id
+    if len(messages) == 1:
+        header = f"{format_user_info(first.from_user)}\n\n📝 Сообщение:\n"
+    else:
+        header = f"{format_user_info(first.from_user)}\n\n📝 Сообщения ({len(messages)}):\n"
+    text = header + "\n\n".join(message.text for message in messages)
+    try:
+        # Длинную пачку режем по лимиту Telegram, каждая часть связана с пользователем
+        for part in split_text(text):
+            result = await bot.send_message(chat_id=ADMIN_GROUP_ID, text=part)
+            await state.set_link(result.message_id, user_id)
+        logging.info(f"Пачка из {len(messages)} сообщений отправлена: {result.message_id}")
+        await confirm_forward(user_id)
+    except Exception as e:
+        await report_forward_error(user_id, e)
+
+# Сборка альбомов из частей
+media_groups = MediaGroupCollector(MEDIA_GROUP_WINDOW)
+
+# Склейка текстов пользователя (None — каждое сообщение уходит сразу)
+forward_coalescer = ForwardCoalescer(
+    FORWARD_COALESCE_SECONDS, FORWARD_COALESCE_MAX, forward_batch_to_admins
+) if FORWARD_COALESCE_SECONDS > 0 else None
+
+async def confirm_forward(user_id):
+    """Подтверждает пользователю отправку с напоминанием о режиме"""
+    send_priority.set(PRIORITY_CONFIRMATION)
+    await bot.send_message(
+        chat_id=user_id,
+        text="✅ Сообщение отправлено админам!\n"
+             "Режим общения активен, можете писать ещё.\n",
+        reply_markup=get_admin_chat_keyboard()
+    )
+
+async def report_forward_error(user_id, error):
+    logging.error(f"Ошибка при отправке сообщения админам: {error}")
+    await bot.send_message(
+        chat_id=user_id,
+        text="❌ Произошла ошибка при отправке сообщения. Попробуйте позже.",
+        reply_markup=get_admin_chat_keyboard()
+    )
+
+async def forward_album_to_admins(messages):
+    """Пересылает альбом пользователя админам одним sendMediaGroup"""
+    user = messages[0].from_user
+    try:
+        header = f"{format_user_info(user)}\n\n🖼 Отправил альбом ({len(messages)})"
+        for message_id in await relay_album(messages, ADMIN_GROUP_ID, header):
+            await state.set_link(message_id, user.id)
+        await confirm_forward(user.id)
+    except Exception as e:
+        await report_forward_error(user.id, e)
+
+async def forward_to_admins(message: types.Message):
+    """Пересылает сообщение пользователя в админский чат"""
+    user_id = message.from_user.id
+    
+    label = USER_CONTENT_LABELS.get(message.content_type)
+    if label is None:
+        # Неподдерживаемый тип
+        await message.answer(
+            "К сожалению, такое сообщение отправить нельзя. "
+            "Только текст, стикеры, гифки, фото, видео, голосовые и файлы.",
+            reply_markup=get_admin_chat_keyboard()
+        )
+        return  # Выходим, не отправляя админам
+    
+    # Альбомы собираются целиком, тексты копятся в пачки,
+    # а всё остальное уходит после накопленного, чтобы не нарушить порядок
+    if message.media_group_id and message.content_type in ALBUM_MEDIA:
+        if forward_coalescer is not None:
+            await forward_coalescer.flush_user(user_id)
+        media_groups.add(message, forward_album_to_admins)
+        return
+    await media_groups.flush_chat(message.chat.id)
+    if forward_coalescer is not None:
+        if message.text:
+            forward_coalescer.add(message)
+            return
+        await forward_coalescer.flush_user(user_id)
+    
+    # НЕ убираем пометку - пользователь остается в режиме общения с админами
+    
+    # Пересылаем сообщение админам
+    try:
+        header = f"{format_user_info(message.from_user)}\n\n{label}"
+        for message_id in await relay_message(message, ADMIN_GROUP_ID, header):
+            # Сохраняем связь между сообщением админа и пользователем
+            await state.set_link(message_id, user_id)
+        
+        logging.info(f"Сообщение отправлено успешно: {message_id}")
+        
+        await confirm_forward(user_id)
+    
+    except Exception as e:
+        await report_forward_error(user_id, e)
+
 @dp.message()
 async def message_handler(message: types.Message):
     """Обработчик всех остальных сообщений"""
     
     # Если сообщение из админского чата и это ответ на сообщение бота
     if str(message.chat.id) == ADMIN_GROUP_ID and message.reply_to_message and message.reply_to_message.from_user.id == bot.id:
-        # Ищем пользователя для ответа
-        original_message_id = message.reply_to_message.message_id
-        target_user_id = admin_message_to_user.get(original_message_id)
-        
-        if target_user_id:
-            try:
-                # Определяем клавиатуру для пользователя
-                keyboard = get_admin_chat_keyboard() if waiting_for_admin_message.get(target_user_id, False) else get_main_keyboard()
-                
-                # Отправляем ответ пользователю в зависимости от типа сообщения админа
-                if message.text:
-                    # Текстовое сообщение от админа
-                    await bot.send_message(
-                        chat_id=target_user_id,
-                        text=f"💬 Ответ от админов:\n\n{message.text}",
-                        reply_markup=keyboard
-                    )
-                elif message.sticker:
-                    # Стикер от админа
-                    await bot.send_message(
-                        chat_id=target_user_id,
-                        text="💬 Ответ от админов:",
-                        reply_markup=keyboard
-                    )
-                    await bot.send_sticker(
-                        chat_id=target_user_id,
-                        sticker=message.sticker.file_id
-                    )
-                elif message.animation:
-                    # Гифка от админа
-                    await bot.send_message(
-                        chat_id=target_user_id,
-                        text="💬 Ответ от админов:",
-                        reply_markup=keyboard
-                    )
-                    await bot.send_animation(
-                        chat_id=target_user_id,
-                        animation=message.animation.file_id,
-                        caption=message.caption
-                    )
-                elif message.photo:
-                    # Фото от админа
-                    caption = "💬 Ответ от админов"
-                    if message.caption:
-                        caption += f":\n\n{message.caption}"
-                    await bot.send_photo(
-                        chat_id=target_user_id,
-                        photo=message.photo[-1].file_id,
-                        caption=caption,
-                        reply_markup=keyboard
-                    )
-                elif message.video:
-                    # Видео от админа
-                    caption = "💬 Ответ от админов"
-                    if message.caption:
-                        caption += f":\n\n{message.caption}"
-                    await bot.send_video(
-                        chat_id=target_user_id,
-                        video=message.video.file_id,
-                        caption=caption,
-                        reply_markup=keyboard
-                    )
-                elif message.voice:
-                    # Голосовое от админа
-                    await bot.send_message(
-                        chat_id=target_user_id,
-                        text="💬 Ответ от админов:",
-                        reply_markup=keyboard
-                    )
-                    await bot.send_voice(
-                        chat_id=target_user_id,
-                        voice=message.voice.file_id
-                    )
-                else:
-                    # Другие типы сообщений
-                    await bot.send_message(
-                        chat_id=target_user_id,
-                        text="💬 Админ отправил ответ (неподдерживаемый тип сообщения)",
-                        reply_markup=keyboard
-                    )
-                
-                # Подтверждаем админу
-                await message.reply("✅ Ответ отправлен пользователю!")
-                
-                # НЕ удаляем связь - теперь можно отвечать много раз на одно сообщение
-                # del admin_message_to_user[original_message_id]
-                
-            except Exception as e:
-                logging.error(f"Ошибка при отправке ответа пользователю: {e}")
-                await message.reply("❌ Ошибка при отправке ответа.")
-        else:
-            await message.reply("❌ Отвечайте именно на стикер.")
+        started = time.perf_counter()
+        await relay_admin_reply(message)
+        handler_latency.observe('message_handler:admin_reply', time.perf_counter() - started)
         return
     
     # Работаем только в личных чатах для обычных пользователей
     if message.chat.type != 'private':
         return
     
-    user_id = message.from_user.id
-    
     # Проверяем, ожидает ли пользователь ввода сообщения для админов
-    if waiting_for_admin_message.get(user_id, False):
-        # НЕ убираем пометку - пользователь остается в режиме общения с админами
-        
-        # Пересылаем сообщение админам
-        try:
-            # Формируем сообщение для админов
-            user_info = f"👤 Пользователь: {message.from_user.full_name}"
-            if message.from_user.username:
-                user_info += f" (@{message.from_user.username})"
-            user_info += f"\n🆔 ID: {message.from_user.id}"
-            
-            # Определяем тип сообщения и отправляем соответственно
-            if message.text:
-                # Текстовое сообщение
-                admin_message = f"{user_info}\n\n📝 Сообщение:\n{message.text}"
-                result = await bot.send_message(
-                    chat_id=ADMIN_GROUP_ID,
-                    text=admin_message
-                )
-            elif message.sticker:
-                # Стикер
-                await bot.send_message(
-                    chat_id=ADMIN_GROUP_ID,
-                    text=f"{user_info}\n\n🎭 Отправил стикер:"
-                )
-                result = await bot.send_sticker(
-                    chat_id=ADMIN_GROUP_ID,
-                    sticker=message.sticker.file_id
-                )
-            elif message.animation:
-                # Гифка (анимация)
-                caption = f"{user_info}\n\n🎬 Отправил гифку"
-                if message.caption:
-                    caption += f":\n{message.caption}"
-                result = await bot.send_animation(
-                    chat_id=ADMIN_GROUP_ID,
-                    animation=message.animation.file_id,
-                    caption=caption
-                )
-            else:
-                # Неподдерживаемый тип
-                await message.answer(
-                    "К сожалению, такое сообщение отправить нельзя. Только текст, стикер или гифку.",
-                    reply_markup=get_admin_chat_keyboard()
-                )
-                return  # Выходим, не отправляя админам
-            
-            # Сохраняем связь между сообщением админа и пользователем
-            admin_message_to_user[result.message_id] = user_id
-            
-            logging.info(f"Сообщение отправлено успешно: {result.message_id}")
-            
-            # Подтверждаем отправку пользователю с напоминанием о режиме
-            await message.answer(
-                "✅ Сообщение отправлено админам!\n"
-                "Режим общения активен, можете писать ещё.\n",
-                reply_markup=get_admin_chat_keyboard()
-            )
-            
-        except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения админам: {e}")
-            await message.answer(
-                "❌ Произошла ошибка при отправке сообщения. Попробуйте позже.",
-                reply_markup=get_admin_chat_keyboard()
-            )
+    if await state.is_waiting(message.from_user.id):
+        started = time.perf_counter()
+        await forward_to_admins(message)
+        handler_latency.observe('message_handler:user_forward', time.perf_counter() - started)
     else:
         # Обычное сообщение - показываем дружелюбное предложение
-        await message.answer(
+        return message.answer(
             "Есть вопрос? Нажмите «Написать админам» 👀",
             reply_markup=get_main_keyboard()
         )
 
-async def on_startup():
-    """Настройка webhook при запуске"""
-    logging.info(f"Настройка webhook: {WEBHOOK_URL}")
-    await bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
+def save_snapshot(path):
+    """Сохраняет состояние из памяти в сжатый JSON (атомарно, через временный файл)"""
+    data = state.snapshot()
+    if data is None:
+        return
+    payload = {'version': 1, 'backend': STATE_BACKEND, 'saved_at': time.time(), 'state': data}
+    temporary = f'{path}.tmp'
+    with gzip.open(temporary, 'wt', encoding='utf-8', compresslevel=5) as snapshot:
+        json.dump(payload, snapshot, separators=(',', ':'))
+    os.replace(temporary, path)
+    logging.info(f"Снимок состояния сохранен: {path}, {os.path.getsize(path)} байт")
+
+def restore_snapshot(path):
+    """Загружает снимок, сохраненный при прошлой остановке, и удаляет его"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as snapshot:
+            payload = json.load(snapshot)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"Снимок состояния {path} не прочитан: {e}")
+        payload = None
+    # Снимок годится один раз: после сбоя старые данные не должны вернуться
+    os.remove(path)
+    if not payload or payload.get('version') != 1 or payload.get('backend') != STATE_BACKEND:
+        return
+    started = time.perf_counter()
+    state.restore(payload['state'])
+    logging.info(
+        f"Состояние восстановлено из снимка от "
+        f"{datetime.fromtimestamp(payload['saved_at']):%d.%m.%Y %H:%M:%S} "
+        f"за {(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+
+async def wait_updates_idle():
+    """Ждет, пока обработчики закончат апдейты, принятые без пула"""
+    while update_counter.in_flight:
+        await asyncio.sleep(0.05)
+
+async def drain_pending_work(timeout):
+    """Дожидается обработки принятых апдейтов и отправки ответов, но не дольше timeout"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    steps = [
+        ('очередь апдейтов', update_pool.drain),
+        ('обработчики', wait_updates_idle),
+    ]
+    if inbound_limiter is not None:
+        steps.append(('отложенные сообщения', inbound_limiter.drain))
+    steps.append(('альбомы', media_groups.drain))
+    if forward_coalescer is not None:
+        steps.append(('склейка сообщений', forward_coalescer.drain))
+    if webhook_handler is not None:
+        steps.append(('ответы webhook', webhook_handler.drain))
+    steps.append(('очередь отправки', send_scheduler.drain))
+    for name, step in steps:
+        try:
+            await asyncio.wait_for(step(), timeout=max(deadline - loop.time(), 0.01))
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Остановка: за {timeout:g} с не дождались шага «{name}» "
+                f"(апдейтов в пуле: {update_pool.pending}, в отправке: {send_scheduler.queue_depth})"
+            )
+            return False
+    return True
+
+async def on_startup(polling=False):
+    """Настройка webhook (или его снятие для long polling) при запуске"""
+    global bot_username
+    if STATE_SNAPSHOT_PATH:
+        restore_snapshot(STATE_SNAPSHOT_PATH)
+    bot_username = (await bot.me()).username
+    if WEBHOOK_WORKERS > 0:
+        update_pool.start()
+    if polling:
+        # Пока установлен webhook, getUpdates не работает. Накопленные апдейты
+        # не сбрасываем: при polling их заберет getUpdates с сохраненного offset
+        setup = bot.delete_webhook(drop_pending_updates=False)
+    else:
+        logging.info(f"Настройка webhook: {WEBHOOK_URL}")
+        setup = bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=WEBHOOK_DROP_PENDING)
+    # Параллельно с настройкой webhook заранее открываем соединения для первых ответов
+    await asyncio.gather(setup, bot.session.prewarm(BOT_API_PREWARM))
+    await broadcast.resume()
 
-async def on_shutdown():
-    """Очистка при завершении"""
-    logging.info("Удаление webhook...")
-    await bot.delete_webhook()
+async def on_shutdown(polling=False):
+    """Плавная остановка: дообработать принятое, сохранить состояние, закрыть ресурсы"""
+    # Если процессов несколько, webhook нужен остальным. Если апдейты за время
+    # перезапуска сохраняются, webhook тоже не трогаем: Telegram придержит их
+    # и доставит новому процессу
+    if not polling and not WEB_REUSE_PORT and WEBHOOK_DROP_PENDING:
+        logging.info("Удаление webhook...")
+        await bot.delete_webhook()
+    # Рассылка продолжится после запуска и не должна занимать очередь отправки
+    await broadcast.close()
+    started = time.perf_counter()
+    if await drain_pending_work(SHUTDOWN_DRAIN_SECONDS):
+        logging.info(f"Очереди обработаны за {time.perf_counter() - started:.1f} с")
+    await update_pool.close()
+    update_dedup.close()
+    if event_log is not None:
+        event_log.close()
+    if STATE_SNAPSHOT_PATH:
+        try:
+            save_snapshot(STATE_SNAPSHOT_PATH)
+        except OSError as e:
+            logging.error(f"Не удалось сохранить снимок состояния: {e}")
     await bot.session.close()
+    await state.close()
 
 async def health_check(request):
     """Health check endpoint для мониторинга"""
     return web.Response(text="Bot is running!")
 
-def main():
-    """Основная функция запуска приложения"""
-    
-    # Создаем веб-приложение
+def render_metrics():
+    """Собирает метрики в текстовом формате Prometheus"""
+    lines = []
+    handler_latency.render(lines)
+    api_metrics.latency.render(lines)
+    lines.append('# HELP bot_api_inline_replies_total Ответы, отданные прямо в ответе на webhook')
+    lines.append('# TYPE bot_api_inline_replies_total counter')
+    for method, count in sorted(api_metrics.inline.items()):
+        lines.append(f'bot_api_inline_replies_total{{method="{method}"}} {count}')
+    lines.append('# HELP bot_api_errors_total Ошибки вызовов Bot API')
+    lines.append('# TYPE bot_api_errors_total counter')
+    for (method, error), count in sorted(api_metrics.errors.items()):
+        lines.append(f'bot_api_errors_total{{method="{method}",error="{error}"}} {count}')
+    gauges = [
+        ('bot_updates_total', 'counter', 'Апдейтов получено', update_counter.total),
+        ('bot_updates_in_flight', 'gauge', 'Апдейтов в обработке', update_counter.in_flight),
+        ('bot_updates_duplicate_total', 'counter', 'Повторных доставок отброшено', update_dedup.duplicates),
+        ('bot_update_queue_pending', 'gauge', 'Апдейтов в пуле воркеров', update_pool.pending),
+        ('bot_update_queue_shed_total', 'counter', 'Апдейтов отклонено при переполнении', update_pool.shed),
+        ('bot_send_queue_depth', 'gauge', 'Запросов ждут отправки', send_scheduler.queue_depth),
+        ('bot_send_delayed_total', 'counter', 'Запросов отложено планировщиком', send_scheduler.delayed),
+        ('bot_send_wait_seconds_total', 'counter', 'Суммарное ожидание в очереди отправки', send_scheduler.wait_total),
+        ('bot_send_retries_total', 'counter', 'Повторов после RetryAfter', send_scheduler.retries),
+    ]
+    gauges.append(('bot_media_groups_pending', 'gauge', 'Частей альбомов ждут отправки', media_groups.pending))
+    if forward_coalescer is not None:
+        gauges.append(('bot_forward_batches_total', 'counter', 'Пачек отправлено админам', forward_coalescer.batches))
+        gauges.append(('bot_forward_merged_total', 'counter', 'Сообщений склеено в пачки', forward_coalescer.merged))
+        gauges.append(('bot_forward_pending', 'gauge', 'Сообщений ждут склейки', forward_coalescer.pending))
+    gauges.append(('bot_api_connections_opened_total', 'counter', 'Новых соединений с Bot API', bot.session.opened))
+    gauges.append(('bot_api_connections_reused_total', 'counter', 'Запросов по открытому соединению', bot.session.reused))
+    idle_connections = bot.session.idle_connections
+    if idle_connections is not None:
+        gauges.append(('bot_api_connections_idle', 'gauge', 'Свободных соединений в пуле', idle_connections))
+    if BOT_MODE == 'polling':
+        gauges.append(('bot_polling_batches_total', 'counter', 'Пачек getUpdates обработано', update_poller.batches))
+        gauges.append(('bot_polling_updates_total', 'counter', 'Апдейтов получено через getUpdates', update_poller.updates))
+        gauges.append(('bot_polling_errors_total', 'counter', 'Ошибок getUpdates', update_poller.errors))
+        gauges.append(('bot_polling_offset', 'gauge', 'Текущий offset getUpdates', update_poller.offset))
+    if inbound_limiter is not None:
+        gauges.append(('bot_inbound_shed_total', 'counter', 'Сообщений отброшено лимитом на пользователя', inbound_limiter.shed))
+        gauges.append(('bot_inbound_deferred_total', 'counter', 'Сообщений отложено лимитом на пользователя', inbound_limiter.deferred))
+        gauges.append(('bot_inbound_warnings_total', 'counter', 'Предупреждений о лимите отправлено', inbound_limiter.warnings))
+        gauges.append(('bot_inbound_tracked_users', 'gauge', 'Пользователей с неполным ведром', inbound_limiter.tracked))
+    if event_log is not None:
+        gauges.append(('bot_event_log_events', 'gauge', 'Событий в журнале', event_log.count))
+    for name, kind, help_text, value in gauges:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {value}')
+    lines.append('# HELP bot_state_entries Записей в структурах состояния в памяти')
+    lines.append('# TYPE bot_state_entries gauge')
+    for name, size in sorted(state.sizes().items()):
+        lines.append(f'bot_state_entries{{structure="{name}"}} {size}')
+    return '\n'.join(lines) + '\n'
+
+async def metrics_handler(request):
+    """Метрики для Prometheus"""
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+def create_status_app():
+    """Веб-приложение только с health check и метриками"""
     app = Application()
-    
-    # Добавляем health check
     app.router.add_get('/', health_check)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    return app
+
+# Обработчик webhook с пулом воркеров, создается в create_app
+webhook_handler = None
+
+def create_app():
+    """Создает веб-приложение с webhook и health check"""
+    global webhook_handler
+    
+    # Создаем веб-приложение с health check и метриками
+    app = create_status_app()
+    
+    # Остановка регистрируется раньше webhook: его обработчик при остановке
+    # закрывает сессию бота, а она еще нужна для отправки ответов из очереди
+    app.on_shutdown.append(lambda app: on_shutdown())
     
     # Настраиваем webhook handler
-    webhook_requests_handler = SimpleRequestHandler(
-        dispatcher=dp,
-        bot=bot,
-    )
+    if WEBHOOK_WORKERS > 0:
+        webhook_requests_handler = webhook_handler = QueuedRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            pool=update_pool,
+            overflow=WEBHOOK_OVERFLOW,
+            reply_timeout=WEBHOOK_REPLY_TIMEOUT,
+        )
+    else:
+        webhook_requests_handler = SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+        )
     webhook_requests_handler.register(app, path=WEBHOOK_PATH)
     
     # Настраиваем приложение
     setup_application(app, dp, bot=bot)
     
-    # Добавляем обработчики запуска и завершения
-    app.on_startup.append(lambda app: asyncio.create_task(on_startup()))
-    app.on_shutdown.append(lambda app: asyncio.create_task(on_shutdown()))
+    # Запуск ждем целиком: сервер начнет принимать апдейты, когда состояние
+    # восстановлено, а воркеры запущены
+    app.on_startup.append(lambda app: on_startup())
+    return app
+
+async def run_polling(port):
+    """Работа через long polling; health check и метрики остаются на port"""
+    await on_startup(polling=True)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, update_poller.stop)
+    status_runner = web.AppRunner(create_status_app())
+    await status_runner.setup()
+    await web.TCPSite(status_runner, '0.0.0.0', port).start()
+    try:
+        await update_poller.run()
+    finally:
+        await on_shutdown(polling=True)
+        await status_runner.cleanup()
+
+def main():
+    """Основная функция запуска приложения"""
+    port = int(os.getenv('PORT', 10000))
+    if BOT_MODE == 'polling':
+        logging.info(f"Запуск в режиме long polling, health check на порту {port}")
+        asyncio.run(run_polling(port))
+        return
+    
+    app = create_app()
     
     # Запускаем веб-сервер
-    port = int(os.getenv('PORT', 10000))
     logging.info(f"Запуск сервера на порту {port}")
-    web.run_app(app, host='0.0.0.0', port=port)
+    web.run_app(app, host='0.0.0.0', port=port, reuse_port=WEB_REUSE_PORT or None)
 
 if __name__ == '__main__':
     main()
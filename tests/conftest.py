@@ -0,0 +1,14 @@
+"""Окружение для импорта main.py в тестах: без сети, журналов и снимков"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault('BOT_TOKEN', '123456:test')
+os.environ.setdefault('ADMIN_GROUP_ID', '-100123')
+workdir = tempfile.mkdtemp()
+os.environ.setdefault('BOT_DB_PATH', os.path.join(workdir, 'test.db'))
+os.environ.setdefault('EVENT_LOG_DIR', '')
+os.environ.setdefault('STATE_SNAPSHOT_PATH', '')
+os.environ.setdefault('UPDATE_DEDUP_PERSIST', '0')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
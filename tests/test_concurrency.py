@@ -0,0 +1,254 @@
+"""Регрессии в конкурентном коде: лимит входящих сообщений, рассылка, Redis.
+
+Запуск: python -m pytest -q tests
+"""
+import asyncio
+import json
+import time
+import types
+
+import pytest
+from aiogram import Dispatcher
+from aiogram.types import Update
+
+import main
+
+
+def test_album_parts_wait_for_deferred_first_part():
+    limiter = main.InboundLimiter(1, 2, max_defer=2)
+    assert limiter.admit(1, 0.0) == 0.0
+    assert limiter.admit(1, 0.0) == 0.0
+    # Ведро пусто: первая часть альбома откладывается, остальные — до того же момента
+    assert limiter.admit(1, 0.0, 'album') == 1.0
+    assert limiter.admit(1, 0.0, 'album') == 1.0
+    assert limiter.admit(1, 0.4, 'album') == 0.6
+    assert limiter.admit(1, 1.5, 'album') == 0.0
+    # Альбом стоил один токен: следующее сообщение встает за ним
+    assert limiter.admit(1, 1.5) == 0.5
+
+
+def test_album_parts_shed_with_first_part():
+    limiter = main.InboundLimiter(1, 1, max_defer=0.5)
+    assert limiter.admit(1, 0.0) == 0.0
+    assert limiter.admit(1, 0.0, 'album') is None
+    assert limiter.admit(1, 0.1, 'album') is None
+    # Новый альбом решается заново
+    assert limiter.admit(1, 1.0, 'other') == 0.0
+
+
+async def _serve_redis(reader, writer):
+    """Заглушка Redis: GET key отвечает значением key, GET slow — с задержкой"""
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        command = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            command.append((await reader.readexactly(size + 2))[:-2])
+        if command[0] == b'GET':
+            if command[1] == b'slow':
+                await asyncio.sleep(0.2)
+            writer.write(b'$%d\r\n%s\r\n' % (len(command[1]), command[1]))
+        else:
+            writer.write(b'+OK\r\n')
+        await writer.drain()
+    writer.close()
+
+
+def _private_message(update_id, user_id=1):
+    return Update.model_validate({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': 0, 'text': 'x',
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'U'},
+        },
+    })
+
+
+def test_deferred_message_stays_in_flight_until_handled():
+    dedup = main.UpdateDeduplicator(100)
+    counter = main.UpdateCounter()
+    limiter = main.InboundLimiter(10, 1, max_defer=1)
+    dispatcher = Dispatcher()
+    for middleware in (dedup, counter, limiter):
+        dispatcher.update.outer_middleware(middleware)
+    handled = []
+    dispatcher.message.register(lambda message: handled.append(message.message_id))
+
+    async def scenario():
+        await dispatcher.feed_update(main.bot, _private_message(1))
+        await dispatcher.feed_update(main.bot, _private_message(2))
+        # Второе сообщение отложено: апдейт еще в обработке
+        assert handled == [1] and limiter.pending == 1
+        assert counter.in_flight == 1 and dedup._in_flight == {2}
+        await limiter.drain()
+        await asyncio.sleep(0)
+        assert handled == [1, 2]
+        assert counter.in_flight == 0 and dedup._in_flight == set()
+
+    asyncio.run(scenario())
+
+
+def test_redis_reply_after_cancelled_command():
+    async def scenario():
+        server = await asyncio.start_server(_serve_redis, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        redis = main.RedisConnection(f'redis://127.0.0.1:{port}/0')
+        try:
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(redis.execute('GET', 'slow'), 0.05)
+            # Ответ на отмененную команду не должен достаться следующей
+            assert await redis.execute('GET', 'fast') == b'fast'
+        finally:
+            await redis.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+ADMIN_CHAT = -100123
+BROADCAST_USERS = list(range(501, 526))
+
+
+class FakeBroadcastBot:
+    """Подменяет методы бота, которые вызывает рассылка"""
+
+    def __init__(self, monkeypatch):
+        self.sent = []
+        self.progress = []
+        monkeypatch.setattr(main.bot, 'send_message', self.send_message)
+        monkeypatch.setattr(main.bot, 'edit_message_text', self.edit_message_text)
+
+    async def send_message(self, chat_id, text):
+        if chat_id == ADMIN_CHAT:
+            self.progress.append(text)
+            return types.SimpleNamespace(message_id=len(self.progress))
+        self.sent.append(chat_id)
+
+    async def edit_message_text(self, chat_id, message_id, text):
+        self.progress.append(text)
+
+
+def _broadcast_job():
+    return {
+        'status': 'running', 'text': 'привет', 'from_chat_id': ADMIN_CHAT, 'message_id': None,
+        'progress_chat_id': ADMIN_CHAT, 'progress_message_id': 1, 'total': len(BROADCAST_USERS),
+        'last_user_id': 0, 'sent': 0, 'blocked': 0, 'failed': 0, 'done': [],
+    }
+
+
+async def _crashed_broadcast(ttl):
+    """Задание 'running' и аренда упавшего процесса, которая истечет через ttl"""
+    for user_id in BROADCAST_USERS:
+        await main.state.record_message(user_id)
+    await main.state.set_meta(main.BroadcastRunner.META_KEY, json.dumps(_broadcast_job()))
+    await main.state.set_meta(main.BroadcastRunner.STOP_KEY, '0')
+    await main.state.release_lease(main.BroadcastRunner.LEASE, 'crashed:1')
+    assert await main.state.acquire_lease(main.BroadcastRunner.LEASE, 'crashed:1', ttl)
+
+
+async def _stored_broadcast():
+    return json.loads(await main.state.get_meta(main.BroadcastRunner.META_KEY))
+
+
+async def _status_is(status):
+    return (await _stored_broadcast())['status'] == status
+
+
+async def _wait_for(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < deadline, "не дождались"
+        await asyncio.sleep(0.02)
+
+
+def test_broadcast_resumes_after_crashed_owner_lease_expires(monkeypatch):
+    fake = FakeBroadcastBot(monkeypatch)
+
+    async def scenario():
+        await _crashed_broadcast(ttl=0.3)
+        runner = main.BroadcastRunner(concurrency=10, progress_interval=0)
+        runner.LEASE_TTL = 0.3
+        await runner.resume()
+        assert not runner.running  # аренда еще у упавшего процесса
+        await _wait_for(lambda: _status_is('done'))
+        await runner.close()
+
+    asyncio.run(scenario())
+    assert sorted(fake.sent) == BROADCAST_USERS
+
+
+def test_broadcast_stop_without_owner_marks_job_stopped(monkeypatch):
+    fake = FakeBroadcastBot(monkeypatch)
+
+    async def scenario():
+        await _crashed_broadcast(ttl=0.01)
+        await asyncio.sleep(0.02)
+        runner = main.BroadcastRunner(concurrency=10, progress_interval=0)
+        await runner.stop()
+        assert not await runner.active()
+
+    asyncio.run(scenario())
+    assert fake.sent == []
+
+
+def test_broadcast_stop_before_restart_is_kept_on_resume(monkeypatch):
+    fake = FakeBroadcastBot(monkeypatch)
+
+    async def scenario():
+        await _crashed_broadcast(ttl=0.3)
+        runner = main.BroadcastRunner(concurrency=10, progress_interval=0)
+        runner.LEASE_TTL = 0.3
+        await runner.stop()  # аренда занята: остается флаг
+        await runner.resume()
+        await _wait_for(lambda: _status_is('stopped'))
+        assert not await runner.active()
+        await runner.close()
+
+    asyncio.run(scenario())
+    assert fake.sent == []
+
+
+def test_broadcast_start_without_lease_posts_nothing(monkeypatch):
+    fake = FakeBroadcastBot(monkeypatch)
+
+    async def scenario():
+        await _crashed_broadcast(ttl=5)
+        runner = main.BroadcastRunner(concurrency=10, progress_interval=0)
+        job = dict(_broadcast_job(), progress_message_id=None)
+        assert not await runner.start(job)
+        await main.state.release_lease(main.BroadcastRunner.LEASE, 'crashed:1')
+
+    asyncio.run(scenario())
+    assert fake.progress == [] and fake.sent == []
+
+
+def test_polling_batch_is_remembered_by_dedup_after_restart(monkeypatch, tmp_path):
+    path = str(tmp_path / 'dedup.db')
+    dedup = main.UpdateDeduplicator(100, path)
+    monkeypatch.setattr(main, 'update_dedup', dedup)
+    dispatcher = Dispatcher()
+    dispatcher.update.outer_middleware(dedup)
+    batch = [
+        Update.model_validate({
+            'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': 'x'},
+        })
+        for update_id in range(1, 6)
+    ]
+
+    class PollingBot:
+        async def get_updates(self, offset, limit, timeout, request_timeout):
+            if offset:
+                poller.stop()
+                return []
+            return batch
+
+    poller = main.UpdatePoller(dispatcher, PollingBot(), None, limit=100, timeout=0)
+    asyncio.run(poller.run())
+    # Процесс упал сразу после пачки: ни одно обработанное update_id не должно пройти снова
+    restarted = main.UpdateDeduplicator(100, path)
+    assert all(restarted.check(update.update_id) for update in batch)